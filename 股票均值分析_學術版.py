@@ -11,11 +11,18 @@ from io import StringIO
 import time
 import schedule
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from contextlib import closing
+from collections import OrderedDict
 import os
 import csv
 import re
 import calendar
 import json
+import queue
+import threading
+import sqlite3
 import logging
 import sys
 import smtplib
@@ -25,7 +32,547 @@ from email.mime.application import MIMEApplication
 import matplotlib.pyplot as plt
 from matplotlib.font_manager import FontProperties
 import matplotlib
-matplotlib.use('Agg')  
+matplotlib.use('Agg')
+
+# 預設的均線窗口
+DEFAULT_MA_WINDOWS = [5, 10, 20]
+
+# 支援的篩選條件：突破 (前一日低於均線、當日高於均線) 與跌破 (反之)，
+# 以及黃金交叉 (快線由下往上穿越慢線) 與死亡交叉 (快線由上往下穿越慢線)
+SCREEN_CONDITIONS = ('breakthrough', 'breakdown', 'golden_cross', 'death_cross')
+CROSS_CONDITIONS = ('golden_cross', 'death_cross')
+
+# 均線欄位名稱：簡單 (MA)、指數 (EMA) 或加權 (WMA) 移動平均加上窗口，如 MA20、EMA12
+AVERAGE_PATTERN = re.compile(r'^(MA|EMA|WMA)(\d+)$')
+
+# 支援的排名指標：價格變化百分比、收盤價高於MA20的距離百分比、成交量相對前20日均量的倍數
+RANK_METRICS = ('price_change_pct', 'ma20_distance_pct', 'volume_surge')
+
+def select_top_n(values, n):
+    """以部分選取 (argpartition) 取得數值最大的前N個位置，只對這N個排序，NaN排在最後
+
+    n 為 None 或 0 時不限制數量
+    """
+    values = np.where(np.isnan(values), -np.inf, values)
+    if not n or n >= len(values):
+        return np.argsort(-values, kind='stable')
+    top = np.argpartition(-values, n - 1)[:n]
+    return top[np.argsort(-values[top], kind='stable')]
+
+def rolling_mean_kernel(values, codes, windows):
+    """對依股票排序的收盤價計算各窗口的簡單移動平均，每支股票各自計算"""
+    grouped = pd.Series(values).groupby(codes, sort=False)
+    out = np.empty((len(values), len(windows)))
+    for i, window in enumerate(windows):
+        out[:, i] = grouped.rolling(window=window, min_periods=window).mean().droplevel(0).sort_index().to_numpy()
+    return out
+
+def recursive_average_kernel(values, codes, windows):
+    """對依股票排序的收盤價以遞迴濾波計算 EMA 與 WMA (未遮蔽暖機期)
+
+    依每支股票的第幾筆觀測分步前進，每一步以向量運算同時更新所有股票
+    """
+    ema_windows, wma_windows = windows
+    state = RecursiveAverages(ema_windows, wma_windows)
+    out = np.empty((len(values), len(state.columns)))
+    if len(values) == 0:
+        return out
+
+    new_group = np.r_[True, codes[1:] != codes[:-1]]
+    group = np.cumsum(new_group) - 1
+    seq = np.arange(len(values)) - np.flatnonzero(new_group)[group]
+    state.positions(np.arange(group[-1] + 1))
+
+    # 依觀測序號排序 (穩定排序保持股票順序)，每一段為同一步的所有股票
+    order = np.argsort(seq, kind='stable')
+    bounds = np.searchsorted(seq[order], np.arange(seq.max() + 2))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        rows = order[start:stop]
+        out[rows] = state.advance(group[rows], values[rows])
+    return out
+
+def shard_worker(kernel, names, n_rows, n_outputs, start, stop, params):
+    """子行程：由共享記憶體讀取一段股票的資料，計算後寫回共享的輸出陣列"""
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    try:
+        values = np.ndarray((n_rows,), dtype=np.float64, buffer=blocks[0].buf)
+        codes = np.ndarray((n_rows,), dtype=np.int64, buffer=blocks[1].buf)
+        out = np.ndarray((n_rows, n_outputs), dtype=np.float64, buffer=blocks[2].buf)
+        out[start:stop] = kernel(values[start:stop], codes[start:stop], params)
+        del values, codes, out
+    finally:
+        for block in blocks:
+            block.close()
+
+def run_sharded(kernel, values, codes, params, n_outputs, workers=1):
+    """將依股票排序的資料沿股票邊界切成數段，以行程池平行執行 kernel
+
+    輸入與輸出透過共享記憶體交換，不需序列化 DataFrame；各段寫回原本的位置，
+    因此結果順序與單一行程相同。workers <= 1 時直接在目前行程計算
+    """
+    n_rows = len(values)
+    if workers is None or workers <= 1 or n_rows == 0:
+        return kernel(values, codes, params)
+
+    # 以列數平均切分，切點對齊到股票的起始列
+    group_starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    targets = np.linspace(0, n_rows, workers + 1)[1:-1]
+    cuts = group_starts[np.minimum(np.searchsorted(group_starts, targets), len(group_starts) - 1)]
+    bounds = np.unique(np.r_[0, cuts, n_rows])
+
+    blocks = [shared_memory.SharedMemory(create=True, size=max(n_rows * 8, 1)),
+              shared_memory.SharedMemory(create=True, size=max(n_rows * 8, 1)),
+              shared_memory.SharedMemory(create=True, size=max(n_rows * n_outputs * 8, 1))]
+    try:
+        np.ndarray((n_rows,), dtype=np.float64, buffer=blocks[0].buf)[:] = values
+        np.ndarray((n_rows,), dtype=np.int64, buffer=blocks[1].buf)[:] = codes
+        names = [block.name for block in blocks]
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(shard_worker, kernel, names, n_rows, n_outputs, start, stop, params)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+
+        return np.ndarray((n_rows, n_outputs), dtype=np.float64, buffer=blocks[2].buf).copy()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+def stock_key(data):
+    """回傳資料中代表股票的欄位：已轉為整數鍵時為 sid，否則為 stock_id"""
+    return 'sid' if 'sid' in data.columns else 'stock_id'
+
+class SymbolMaster:
+    """股票代號主檔：將代號對應到精簡的整數鍵 (sid)，並記錄市場、名稱變更歷史、上市與下市日期
+
+    上市日期為首次出現在行情資料的日期，下市日期為同市場已有超過 delist_days 天的新資料
+    但該股票未再出現時的最後交易日；之後若再次出現會清除下市日期
+    """
+    def __init__(self, master_file=None, delist_days=30):
+        self.master_file = master_file
+        self.delist_days = delist_days
+        self.table = pd.DataFrame({
+            'stock_id': pd.Series(dtype=object),
+            'market': pd.Series(dtype=object),
+            'listed': pd.Series(dtype='datetime64[ns]'),
+            'last_seen': pd.Series(dtype='datetime64[ns]'),
+            'delisted': pd.Series(dtype='datetime64[ns]')
+        })
+        self.names = pd.DataFrame({
+            'sid': pd.Series(dtype=np.int32),
+            'date': pd.Series(dtype='datetime64[ns]'),
+            'name': pd.Series(dtype=object)
+        })
+        self.index = pd.Index([], dtype=object)
+        if master_file and os.path.exists(master_file):
+            self.load()
+
+    def __len__(self):
+        return len(self.table)
+
+    def load(self):
+        """載入保存的主檔"""
+        try:
+            saved = pd.read_pickle(self.master_file)
+            self.table = saved['table']
+            self.names = saved['names']
+            self.index = pd.Index(self.table['stock_id'])
+            logging.info(f"已載入股票主檔: {len(self.table)} 支股票")
+        except Exception as e:
+            logging.warning(f"讀取股票主檔 {self.master_file} 時發生錯誤: {e}")
+
+    def save(self):
+        """保存主檔，整數鍵需與報價資料一致"""
+        if not self.master_file:
+            return
+        try:
+            pd.to_pickle({'table': self.table, 'names': self.names}, self.master_file)
+        except Exception as e:
+            logging.error(f"保存股票主檔時發生錯誤: {e}")
+
+    def encode(self, stock_ids):
+        """將股票代號轉為整數鍵，未知的代號為 -1"""
+        return self.index.get_indexer(stock_ids).astype(np.int32)
+
+    def update(self, data):
+        """以新抓取的資料增量更新主檔：新增代號、名稱變更、上市與下市日期"""
+        if data.empty:
+            return
+
+        # 每支股票在這批資料中的首末日期與市場
+        seen = data.groupby('stock_id', sort=False).agg(first=('date', 'min'), last=('date', 'max'),
+                                                         market=('market', 'last'))
+        new_ids = seen.index[self.index.get_indexer(seen.index) < 0]
+        if len(new_ids):
+            added = pd.DataFrame({'stock_id': new_ids, 'market': seen.loc[new_ids, 'market'].to_numpy(),
+                                  'listed': seen.loc[new_ids, 'first'].to_numpy(),
+                                  'last_seen': seen.loc[new_ids, 'last'].to_numpy(),
+                                  'delisted': pd.NaT})
+            self.table = pd.concat([self.table, added], ignore_index=True)
+            self.index = pd.Index(self.table['stock_id'])
+            logging.info(f"股票主檔新增 {len(new_ids)} 支股票")
+
+        sids = self.encode(seen.index)
+        self.table.loc[sids, 'market'] = seen['market'].to_numpy()
+        self.table.loc[sids, 'listed'] = np.minimum(self.table.loc[sids, 'listed'].to_numpy(), seen['first'].to_numpy())
+        self.table.loc[sids, 'last_seen'] = np.maximum(self.table.loc[sids, 'last_seen'].to_numpy(), seen['last'].to_numpy())
+
+        # 名稱變更：與歷史中前一個名稱不同的 (股票, 名稱) 組合才記錄
+        combos = data.groupby(['stock_id', 'stock_name'], sort=False)['date'].min().reset_index()
+        combos = pd.DataFrame({'sid': self.encode(combos['stock_id']), 'date': combos['date'].to_numpy(),
+                               'name': combos['stock_name'].to_numpy(), 'is_new': True})
+        merged = pd.concat([self.names.assign(is_new=False), combos], ignore_index=True)
+        merged = merged.sort_values(['sid', 'date', 'is_new'], kind='mergesort')
+        changed = (merged['sid'] != merged['sid'].shift()) | (merged['name'] != merged['name'].shift())
+        renamed = merged[changed & merged['is_new']].drop(columns='is_new')
+        if not renamed.empty:
+            renames = renamed['sid'].isin(self.names['sid']).sum()
+            self.names = pd.concat([self.names, renamed], ignore_index=True)
+            if renames:
+                logging.info(f"股票主檔記錄 {renames} 筆名稱變更")
+
+        # 同市場的資料已超過 delist_days 天未出現者視為下市，再次出現則清除
+        market_latest = self.table.groupby('market')['last_seen'].transform('max')
+        stale = self.table['last_seen'] < market_latest - pd.Timedelta(days=self.delist_days)
+        self.table['delisted'] = self.table['last_seen'].where(stale)
+
+    def intern(self, data):
+        """將資料中的代號、名稱與市場欄位換成整數鍵 sid"""
+        data = data.copy()
+        data['sid'] = self.encode(data['stock_id'])
+        return data.drop(columns=[col for col in ('stock_id', 'stock_name', 'market') if col in data.columns])
+
+    def markets_of(self, sids):
+        """回傳整數鍵對應的市場"""
+        return self.table['market'].to_numpy()[np.asarray(sids, dtype=np.int64)]
+
+    def names_on(self, sids, date=None):
+        """回傳整數鍵在指定日期 (未指定時為最新) 的股票名稱"""
+        history = self.names if date is None else self.names[self.names['date'] <= date]
+        latest = history.sort_values('date', kind='mergesort').drop_duplicates('sid', keep='last').set_index('sid')['name']
+        names = latest.reindex(np.asarray(sids)).to_numpy()
+        # 指定日期早於首次出現時，以最早的名稱代替
+        if date is not None and pd.isna(names).any():
+            earliest = self.names.sort_values('date', kind='mergesort').drop_duplicates('sid').set_index('sid')['name']
+            names = np.where(pd.isna(names), earliest.reindex(np.asarray(sids)).to_numpy(), names)
+        return names
+
+    def decode(self, data, date=None):
+        """將整數鍵 sid 轉回代號、名稱 (以指定日期的名稱為準) 與市場欄位"""
+        sids = data['sid'].to_numpy(dtype=np.int64)
+        data = data.drop(columns='sid')
+        data.insert(0, 'market', self.markets_of(sids))
+        data.insert(0, 'stock_name', self.names_on(sids, date))
+        data.insert(0, 'stock_id', self.table['stock_id'].to_numpy()[sids])
+        return data
+
+class RecursiveAverages:
+    """EMA 與 WMA 的遞迴濾波狀態，沿股票向量化
+
+    每支股票保存觀測筆數、各窗口的 EMA 值，以及 WMA 最近 window 筆收盤價的環狀緩衝區、
+    總和與加權總和，新增一個交易日只需 O(股票數) 的運算。EMA 以第一筆收盤價起算
+    (等同 ewm(span=window, adjust=False))；兩者在累積 window 筆之前皆為 NaN
+    """
+    def __init__(self, ema_windows=(), wma_windows=()):
+        self.ema_windows = sorted({int(w) for w in ema_windows})
+        self.wma_windows = sorted({int(w) for w in wma_windows})
+        self.keys = pd.Index([])
+        self.count = np.zeros(0, dtype=np.int64)
+        self.ema = {w: np.zeros(0) for w in self.ema_windows}
+        self.buffer = {w: np.zeros((w, 0)) for w in self.wma_windows}
+        self.total = {w: np.zeros(0) for w in self.wma_windows}
+        self.weighted = {w: np.zeros(0) for w in self.wma_windows}
+        self.last_date = None
+
+    @property
+    def columns(self):
+        """輸出的指標欄位名稱"""
+        return [f'EMA{w}' for w in self.ema_windows] + [f'WMA{w}' for w in self.wma_windows]
+
+    @property
+    def windows(self):
+        """與 columns 對應的窗口"""
+        return self.ema_windows + self.wma_windows
+
+    def positions(self, keys):
+        """回傳股票鍵在狀態陣列中的位置，新出現的股票會擴充狀態"""
+        keys = pd.Index(keys)
+        idx = self.keys.get_indexer(keys)
+        new_keys = keys[idx < 0].unique()
+        if len(new_keys):
+            n = len(new_keys)
+            self.keys = self.keys.append(new_keys) if len(self.keys) else new_keys
+            self.count = np.r_[self.count, np.zeros(n, dtype=np.int64)]
+            for w in self.ema_windows:
+                self.ema[w] = np.r_[self.ema[w], np.zeros(n)]
+            for w in self.wma_windows:
+                self.buffer[w] = np.hstack([self.buffer[w], np.zeros((w, n))])
+                self.total[w] = np.r_[self.total[w], np.zeros(n)]
+                self.weighted[w] = np.r_[self.weighted[w], np.zeros(n)]
+            idx = self.keys.get_indexer(keys)
+        return idx
+
+    def advance(self, idx, closes):
+        """以一個交易日的收盤價更新指定位置的股票，回傳各指標當日的值 (未遮蔽暖機期)"""
+        count = self.count[idx]
+        out = np.empty((len(idx), len(self.columns)))
+        for i, w in enumerate(self.ema_windows):
+            alpha = 2.0 / (w + 1)
+            prev = self.ema[w][idx]
+            value = np.where(count == 0, closes, (1 - alpha) * prev + alpha * closes)
+            self.ema[w][idx] = value
+            out[:, i] = value
+        for i, w in enumerate(self.wma_windows, start=len(self.ema_windows)):
+            # 緩衝區已滿時移出最舊的一筆，其餘權重各減一，新資料權重為 window
+            slot = count % w
+            full = count >= w
+            oldest = self.buffer[w][slot, idx]
+            total = self.total[w][idx]
+            weighted = np.where(full, self.weighted[w][idx] + w * closes - total,
+                                self.weighted[w][idx] + (count + 1) * closes)
+            self.total[w][idx] = np.where(full, total + closes - oldest, total + closes)
+            self.weighted[w][idx] = weighted
+            self.buffer[w][slot, idx] = closes
+            out[:, i] = weighted / (w * (w + 1) / 2)
+        self.count[idx] = count + 1
+        return out
+
+    def mask_warmup(self, values, counts):
+        """將觀測筆數 (含當筆) 少於窗口的指標值設為 NaN"""
+        values = values.copy()
+        values[np.asarray(counts)[:, None] < np.array(self.windows, dtype=np.int64)] = np.nan
+        return values
+
+    def load_history(self, keys, codes, closes, raw):
+        """由整段歷史的計算結果建立狀態
+
+        codes 為依股票排序的位置 (對應 keys)，raw 為 recursive_average_kernel 的輸出；
+        EMA 取每支股票最後一筆的值，WMA 的緩衝區與總和由最後 window 筆收盤價重建
+        """
+        idx = self.positions(keys)[codes]
+        n = len(self.keys)
+        new_group = np.r_[True, codes[1:] != codes[:-1]] if len(codes) else np.zeros(0, dtype=bool)
+        seq = np.arange(len(codes)) - np.flatnonzero(new_group)[np.cumsum(new_group) - 1]
+        last = np.r_[np.flatnonzero(new_group)[1:] - 1, len(codes) - 1] if len(codes) else np.zeros(0, dtype=np.int64)
+
+        stocks = idx[last]
+        self.count[stocks] = seq[last] + 1
+        for i, w in enumerate(self.ema_windows):
+            self.ema[w][stocks] = raw[last, i]
+        for w in self.wma_windows:
+            start = np.maximum(self.count[idx] - w, 0)
+            tail = seq >= start
+            self.buffer[w][:, stocks] = 0.0
+            self.buffer[w][seq[tail] % w, idx[tail]] = closes[tail]
+            weights = seq[tail] - start[tail] + 1
+            self.total[w][stocks] = np.bincount(idx[tail], weights=closes[tail], minlength=n)[stocks]
+            self.weighted[w][stocks] = np.bincount(idx[tail], weights=weights * closes[tail], minlength=n)[stocks]
+
+    def replace(self, other):
+        """以另一個狀態 (例如重新計算的部分股票) 取代對應股票的狀態"""
+        idx = self.positions(other.keys)
+        self.count[idx] = other.count
+        for w in self.ema_windows:
+            self.ema[w][idx] = other.ema[w]
+        for w in self.wma_windows:
+            self.buffer[w][:, idx] = other.buffer[w]
+            self.total[w][idx] = other.total[w]
+            self.weighted[w][idx] = other.weighted[w]
+
+class StockPanel:
+    """延遲計算並快取結果的股票資料集，供 notebook 或其他腳本使用
+
+    panel.close、panel.ma(20)、panel.ema(12)、panel.signals(rule) 等皆為 日期 x 股票 的寬表，
+    第一次存取時才計算並快取 (回傳的是快取本身，請勿就地修改)；均線依 (種類, 窗口)、訊號依規則
+    各自以 LRU 保留最多 cache_size 個結果。ingest 新資料後，只有收盤價新增或改變的股票，
+    自其最早受影響的日期起的儲存格會在下次存取時重新計算
+    """
+    def __init__(self, analyzer, source, cache_size=8):
+        self.analyzer = analyzer
+        self.source = source  # 第一次存取時呼叫以取得資料
+        self.cache_size = cache_size
+        self._data = None
+        self._dates = None  # 日期與股票索引，ingest 時重設
+        self._stocks = None
+        self.fields = {}
+        self.averages = OrderedDict()
+        self.rules = OrderedDict()
+
+    @property
+    def data(self):
+        """檢查與還原調整後的長表資料 (第一次存取時載入)"""
+        if self._data is None:
+            self._data = pd.DataFrame()
+            self.ingest(self.source())
+        return self._data
+
+    @property
+    def key(self):
+        return stock_key(self.data)
+
+    @property
+    def dates(self):
+        if self._dates is None:
+            self._dates = pd.DatetimeIndex(np.unique(self.data['date'].to_numpy(dtype='datetime64[ns]')))
+        return self._dates
+
+    @property
+    def stocks(self):
+        if self._stocks is None:
+            self._stocks = pd.Index(np.sort(self.data[self.key].unique()))
+        return self._stocks
+
+    @property
+    def close(self):
+        return self.field('close')
+
+    @property
+    def volume(self):
+        return self.field('volume')
+
+    def field(self, name):
+        """原始欄位的寬表 (不受 LRU 限制)"""
+        return self.cached(self.fields, name, lambda stocks: self.pivot(self.rows(stocks), name), limit=False)
+
+    def ma(self, window):
+        return self.average(f'MA{window}')
+
+    def ema(self, window):
+        return self.average(f'EMA{window}')
+
+    def wma(self, window):
+        return self.average(f'WMA{window}')
+
+    def average(self, name):
+        """依名稱 (如 MA20、EMA12、WMA10) 取得均線寬表"""
+        match = AVERAGE_PATTERN.match(name)
+        if not match:
+            raise ValueError(f"不支援的均線名稱: {name}")
+        kind, window = match.group(1), int(match.group(2))
+        return self.cached(self.averages, name, lambda stocks: self.compute_average(kind, window, stocks))
+
+    def signals(self, rule):
+        """依規則取得每個交易日是否出現訊號的布林寬表
+
+        rule 可為策略設定組名稱、策略設定組 (dict，格式同 config.json 的 profiles) 或篩選條件名稱；
+        判斷方式與 filter_stocks 相同，以前一個交易日與當日比較
+        """
+        profile = self.resolve_rule(rule)
+        rule_key = (profile['condition'], tuple(profile['averages']), profile['fast'], profile['slow'])
+        return self.cached(self.rules, rule_key, lambda stocks: self.compute_signals(profile, stocks),
+                           fill_value=False)
+
+    def ingest(self, new_data):
+        """併入新資料 (檢查資料品質並套用還原調整)，只讓受影響股票與日期的快取失效"""
+        if new_data is None or new_data.empty:
+            return
+        old = self.data
+        checked = self.analyzer.validate_quotes(new_data, old if not old.empty else None)
+        # 資料集不保存報價，公司行動紀錄只由 run_analysis 寫入
+        combined = self.analyzer.update_quote_store(old, checked, record=False)
+
+        # 新增或收盤價改變的列，每支股票取最早的日期
+        key = stock_key(combined)
+        if old.empty:
+            changed = combined
+        else:
+            previous = old[[key, 'date', 'close']].rename(columns={'close': 'previous_close'})
+            merged = combined[[key, 'date', 'close']].merge(previous, on=[key, 'date'], how='left')
+            changed = merged[merged['previous_close'].isna() | (merged['close'] != merged['previous_close'])]
+        affected = changed.groupby(key)['date'].min()
+
+        self._data = combined
+        self._dates = self._stocks = None
+        for cache in (self.fields, self.averages, self.rules):
+            for entry in cache.values():
+                entry['dirty'] = pd.concat([entry['dirty'], affected]).groupby(level=0).min()
+        logging.info(f"資料集併入 {len(checked)} 筆資料，{len(affected)} 支股票的快取需要更新")
+
+    def cached(self, cache, name, compute, limit=True, fill_value=np.nan):
+        """取得快取結果，只重新計算失效的股票並只替換受影響日期的儲存格"""
+        entry = cache.get(name)
+        if entry is None or not entry['dirty'].empty:
+            dates, stocks = self.dates, self.stocks
+        if entry is None:
+            frame = compute(stocks).reindex(index=dates, columns=stocks, fill_value=fill_value)
+            entry = cache[name] = {'frame': frame, 'dirty': pd.Series(dtype='datetime64[ns]')}
+        elif not entry['dirty'].empty:
+            dirty = entry['dirty']
+            frame = entry['frame'].reindex(index=dates, columns=stocks, fill_value=fill_value)
+            fresh = compute(dirty.index).reindex(index=dates, columns=dirty.index, fill_value=fill_value)
+            stale = dates.to_numpy()[:, None] >= dirty.to_numpy(dtype='datetime64[ns]')[None, :]
+            frame[dirty.index] = frame[dirty.index].where(~stale, fresh)
+            entry['frame'] = frame
+            entry['dirty'] = pd.Series(dtype='datetime64[ns]')
+
+        if limit:
+            cache.move_to_end(name)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return entry['frame']
+
+    def rows(self, stocks):
+        """指定股票依 (股票, 日期) 排序的長表資料"""
+        data = self.data
+        return data[data[self.key].isin(stocks)].sort_values([self.key, 'date'])
+
+    def pivot(self, rows, column, values=None):
+        """將長表的欄位 (或與列對應的 values) 轉為 日期 x 股票 的寬表"""
+        values = rows[column].to_numpy() if values is None else values
+        return pd.DataFrame({'date': rows['date'].to_numpy(), 'stock': rows[self.key].to_numpy(), 'value': values}) \
+            .pivot(index='date', columns='stock', values='value')
+
+    def compute_average(self, kind, window, stocks):
+        """只對指定股票計算單一均線"""
+        rows = self.rows(stocks)
+        codes = pd.factorize(rows[self.key])[0]
+        closes = rows['close'].to_numpy(dtype=float)
+        if kind == 'MA':
+            values = rolling_mean_kernel(closes, codes, [window])[:, 0]
+        else:
+            state = RecursiveAverages([window] if kind == 'EMA' else [], [window] if kind == 'WMA' else [])
+            raw = recursive_average_kernel(closes, codes, (state.ema_windows, state.wma_windows))
+            seq = rows.groupby(self.key, sort=False).cumcount().to_numpy()
+            values = state.mask_warmup(raw, seq + 1)[:, 0]
+        return self.pivot(rows, 'close', values)
+
+    def resolve_rule(self, rule):
+        """將規則轉為解析後的策略設定組"""
+        if isinstance(rule, str):
+            named = [profile for profile in self.analyzer.profiles if profile['name'] == rule]
+            if named:
+                return named[0]
+            rule = {'name': rule, 'condition': rule}
+        resolved = self.analyzer.load_profiles({'profiles': [rule]})
+        if not resolved:
+            raise ValueError(f"無效的訊號規則: {rule}")
+        return resolved[0]
+
+    def compute_signals(self, profile, stocks):
+        """以均線寬表計算指定股票在每個交易日是否出現訊號
+
+        每個交易日與資料集中的前一個交易日比較，該股票前一個交易日沒有資料時不會出現訊號；
+        與 filter_stocks 以相鄰兩個交易日篩選、calculate_crossovers 標記的交叉一致
+        """
+        close = self.close[stocks]
+        if profile['condition'] in CROSS_CONDITIONS:
+            diff = self.average(profile['fast'])[stocks] - self.average(profile['slow'])[stocks]
+            prev = diff.shift(1)
+            if profile['condition'] == 'golden_cross':
+                return (prev <= 0) & (diff > 0)
+            return (prev >= 0) & (diff < 0)
+
+        above = pd.DataFrame(True, index=close.index, columns=close.columns)
+        below = above.copy()
+        for name in profile['averages']:
+            average = self.average(name)[stocks]
+            above &= close > average
+            below &= close < average
+        if profile['condition'] == 'breakthrough':
+            return below.shift(1, fill_value=False) & above
+        return above.shift(1, fill_value=False) & below
 
 class TWStockAnalyzer:
     def __init__(self, config_file='config.json'):
@@ -47,6 +594,12 @@ class TWStockAnalyzer:
             ]
         )
         
+        # 股票代號主檔 (整數鍵、名稱變更歷史)
+        self.symbols = SymbolMaster(os.path.join(self.export_path, self.symbol_master) if self.symbol_master else None)
+        
+        # pyplot 使用全域狀態，並行繪製圖表時需要互斥
+        self.chart_lock = threading.Lock()
+        
         # 設置請求頭
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
@@ -63,7 +616,19 @@ class TWStockAnalyzer:
             self.export_filename = config.get('export_filename', 'tw_stock_ma_breakthrough_{date}.csv')
             self.run_time = config.get('run_time', '18:30')  # 保留但不再使用於排程
             self.holidays = [datetime.strptime(date, '%Y-%m-%d') for date in config.get('holidays', [])]
-            
+            self.quote_store = config.get('quote_store', 'quote_store.pkl')  # 空字串表示不保存報價資料
+            self.symbol_master = config.get('symbol_master', 'symbol_master.pkl')  # 需與報價資料一起保存
+            self.price_limit = config.get('price_limit', 0.10)  # 每日漲跌幅限制
+            self.signal_index = config.get('signal_index', 'signal_index.db')  # 空字串表示不記錄訊號
+            self.indicator_state = config.get('indicator_state', 'indicator_state.pkl')  # EMA/WMA遞迴狀態，需與報價資料一起保存
+            self.workers = config.get('workers', 1)  # 指標計算使用的行程數
+            self.output_workers = config.get('output_workers', 4)  # 輸出與寄送使用的執行緒數
+            self.columnar_export = config.get('columnar_export', False)  # 另存Parquet欄式檔案
+            self.response_archive = config.get('response_archive', '')  # 保存原始回應的子目錄，空字串表示不保存
+
+            # 載入策略設定組（未設定時以頂層設定建立單一預設組）
+            self.profiles = self.load_profiles(config)
+
             # 確保匯出目錄存在
             if not os.path.exists(self.export_path):
                 os.makedirs(self.export_path)
@@ -77,6 +642,16 @@ class TWStockAnalyzer:
             self.export_filename = 'tw_stock_ma_breakthrough_{date}.csv'
             self.run_time = '18:30'
             self.holidays = []
+            self.quote_store = 'quote_store.pkl'
+            self.symbol_master = 'symbol_master.pkl'
+            self.price_limit = 0.10
+            self.signal_index = 'signal_index.db'
+            self.indicator_state = 'indicator_state.pkl'
+            self.workers = 1
+            self.output_workers = 4
+            self.columnar_export = False
+            self.response_archive = ''
+            self.profiles = self.load_profiles({})
 
             if not os.path.exists(self.export_path):
                 os.makedirs(self.export_path)
@@ -94,7 +669,114 @@ class TWStockAnalyzer:
                 print(f"已建立預設的設定檔：{config_file}")
             except Exception as write_error:
                 print(f"寫入預設設定檔失敗: {write_error}")
-        
+
+    def load_profiles(self, config):
+        """解析設定檔中的策略設定組 (profiles)，每組可有自己的均線、條件與收件人
+
+        windows、ema_windows、wma_windows 為突破/跌破比較的簡單、指數與加權均線窗口；
+        交叉條件以 fast 與 slow 指定快線與慢線 (如 MA5、EMA12)
+        """
+        profiles = config.get('profiles') or [{'name': 'default'}]
+        single = len(profiles) == 1
+
+        resolved = []
+        for i, profile in enumerate(profiles):
+            if not isinstance(profile, dict):
+                print(f"第 {i + 1} 個策略設定組 {profile!r} 不是物件，已略過")
+                continue
+            name = profile.get('name', f'profile{i + 1}')
+            # 組名用於結果、輸出檔名與訊號索引，必須唯一
+            if any(existing['name'] == name for existing in resolved):
+                print(f"策略設定組名稱 {name} 重複，已略過")
+                continue
+            condition = profile.get('condition', 'breakthrough')
+            if condition not in SCREEN_CONDITIONS:
+                print(f"策略設定組 {name} 的條件 {condition} 不支援，已略過")
+                continue
+
+            # 交叉條件預設不需要與收盤價比較的均線
+            cross = condition in CROSS_CONDITIONS
+            try:
+                windows = sorted({int(w) for w in profile.get('windows', [] if cross else DEFAULT_MA_WINDOWS)})
+                ema_windows = sorted({int(w) for w in profile.get('ema_windows', [])})
+                wma_windows = sorted({int(w) for w in profile.get('wma_windows', [])})
+            except (TypeError, ValueError):
+                print(f"策略設定組 {name} 的均線設定無效，已略過")
+                continue
+            averages = ([f'MA{w}' for w in windows] + [f'EMA{w}' for w in ema_windows] +
+                        [f'WMA{w}' for w in wma_windows])
+
+            fast = profile.get('fast')
+            slow = profile.get('slow')
+            if cross and not (isinstance(fast, str) and isinstance(slow, str) and fast != slow and
+                              AVERAGE_PATTERN.match(fast) and AVERAGE_PATTERN.match(slow)):
+                print(f"策略設定組 {name} 的交叉條件需要不同的 fast 與 slow 均線 (如 MA5、EMA12)，已略過")
+                continue
+            if not cross and not averages:
+                print(f"策略設定組 {name} 沒有設定均線，已略過")
+                continue
+
+            # top_n 為 null 或 0 時不限制數量
+            top_n = profile.get('top_n', 30)
+            try:
+                top_n = int(top_n) if top_n is not None else None
+            except (TypeError, ValueError):
+                top_n = -1
+            if top_n is not None and top_n < 0:
+                print(f"策略設定組 {name} 的 top_n {profile.get('top_n')!r} 不是非負整數，已略過")
+                continue
+
+            rank_by = profile.get('rank_by', 'price_change_pct')
+            if rank_by not in RANK_METRICS:
+                print(f"策略設定組 {name} 的排名指標 {rank_by} 不支援，改用 price_change_pct")
+                rank_by = 'price_change_pct'
+
+            # 收件人可為單一字串或列表，未設定時沿用頂層的 to
+            to = profile.get('to', config.get('to', ''))
+            if isinstance(to, str):
+                to = [to] if to else []
+
+            # 只有一組時沿用原本的檔名，多組時以組名區分輸出檔案
+            if single:
+                default_export = self.export_filename
+                default_chart = 'tw_stock_ma_breakthrough_chart_{date}.pdf'
+                default_delta = 'tw_stock_ma_delta_{date}.csv'
+                default_full = 'tw_stock_ma_breakthrough_full_{date}.csv'
+            else:
+                default_export = 'tw_stock_ma_breakthrough_{profile}_{date}.csv'
+                default_chart = 'tw_stock_ma_breakthrough_chart_{profile}_{date}.pdf'
+                default_delta = 'tw_stock_ma_delta_{profile}_{date}.csv'
+                default_full = 'tw_stock_ma_breakthrough_full_{profile}_{date}.csv'
+
+            resolved.append({
+                'name': name,
+                'windows': windows,
+                'ema_windows': ema_windows,
+                'wma_windows': wma_windows,
+                'averages': averages,
+                'condition': condition,
+                'fast': fast if cross else None,
+                'slow': slow if cross else None,
+                'rank_by': rank_by,
+                'top_n': top_n,  # 報告、圖表與日誌只列出前N名
+                'to': to,
+                'sub': profile.get('sub', config.get('sub', '')),
+                'context': profile.get('context', config.get('context', '')),
+                'nofile_sub': profile.get('nofile_sub', config.get('nofile_sub', '')),
+                'nofile_context': profile.get('nofile_context', config.get('nofile_context', '')),
+                'export_filename': profile.get('export_filename', default_export),
+                'chart_filename': profile.get('chart_filename', default_chart),
+                'delta_filename': profile.get('delta_filename', default_delta),
+                'full_filename': profile.get('full_filename', default_full)
+            })
+
+        return resolved
+
+    def profile_path(self, pattern, profile, date):
+        """依策略設定組與日期產生輸出檔案路徑"""
+        filename = pattern.format(date=date.strftime('%Y%m%d'), profile=profile['name'])
+        return os.path.join(self.export_path, filename)
+
     def is_trading_day(self, date):
         """檢查指定日期是否為交易日"""
         # 週末不交易
@@ -163,80 +845,26 @@ class TWStockAnalyzer:
                 logging.error(f"無法解碼 {date_str} 的TWSE數據")
                 return pd.DataFrame()
             
-            # 尋找股票資料的部分
-            lines = content.split('\n')
-            start_idx = -1
-            for i, line in enumerate(lines):
-                if '"證券代號"' in line and '"證券名稱"' in line and '"收盤價"' in line:
-                    start_idx = i
-                    break
-            
-            if start_idx == -1:
-                logging.error(f"無法找到 {date_str} 的TWSE股票數據表格")
-                return pd.DataFrame()
-            
-            # 提取有效的資料行
-            data_lines = []
-            data_lines.append(lines[start_idx])  # 加入標題行
-            
-            for line in lines[start_idx+1:]:
-                # 檢查行是否包含股票數據 (通常以數字開頭)
-                if line.strip() and re.match(r'^"[0-9]{4,}"', line.strip()):
-                    data_lines.append(line)
-                elif line.strip() and '==================================' in line:
-                    break  # 發現分隔線，表示數據結束
-            
-            # 如果沒有數據，返回空DataFrame
-            if len(data_lines) <= 1:
-                logging.warning(f"TWSE在 {date_str} 未找到股票數據")
-                return pd.DataFrame()
-            
-            # 手動解析CSV數據
-            csv_data = []
-            header = None
-            
-            for i, line in enumerate(data_lines):
-                # 使用CSV模塊來正確處理CSV格式
-                reader = csv.reader(StringIO(line), delimiter=',', quotechar='"')
-                row = next(reader)
-                
-                if i == 0:  # 這是標題行
-                    header = [col.strip('"').strip() for col in row]
-                    # 查找必要列的索引
-                    try:
-                        code_idx = header.index('證券代號')
-                        name_idx = header.index('證券名稱')
-                        close_idx = header.index('收盤價')
-                    except ValueError:
-                        logging.error(f"TWSE數據缺少必要的列: {header}")
-                        return pd.DataFrame()
-                else:
-                    if len(row) >= max(code_idx, name_idx, close_idx) + 1:
-                        csv_data.append({
-                            'stock_id': row[code_idx].strip('"'),
-                            'stock_name': row[name_idx].strip('"'),
-                            'close': row[close_idx].strip('"').replace(',', '')
-                        })
-            
-            # 創建DataFrame
-            df = pd.DataFrame(csv_data)
-            
-            # 確保收盤價是數值型
-            df['close'] = pd.to_numeric(df['close'], errors='coerce')
-            
-            # 過濾掉非數值的行及特殊股票
-            df = df.dropna(subset=['close'])
-            df = df[df['stock_id'].str.isdigit()]  # 只保留數字股票代碼
-            
-            # 設置日期列
-            df['date'] = date
-            
-            return df
+            self.archive_response('twse', date, content)
+            return self.attach_ex_reference('twse', date, self.parse_twse_content(content, date))
                 
         except Exception as e:
             logging.error(f"獲取TWSE數據時發生錯誤: {e}")
             return pd.DataFrame()
     
+    def parse_twse_change(self, row, sign_idx, change_idx):
+        """解析TWSE的漲跌符號與漲跌價差，回傳帶正負號的漲跌字串"""
+        if sign_idx is None or change_idx is None or len(row) <= max(sign_idx, change_idx):
+            return ''
+        sign = row[sign_idx]
+        change = row[change_idx].strip('"').replace(',', '')
+        # X 表示不比價 (如除權息、新上市)，無法推算參考價
+        if 'X' in sign:
+            return ''
+        if '-' in sign:
+            return f'-{change}'
+        return change
+    
     def fetch_tpex_data(self, date):
         """獲取證券櫃檯買賣中心(TPEx)上櫃公司的每日收盤價資料"""
         year = date.year - 1911  # 轉換為民國年
@@ -266,90 +894,254 @@ class TWStockAnalyzer:
                 logging.error(f"無法解碼 {date} 的TPEx數據")
                 return pd.DataFrame()
             
-            # 檢查是否有數據
-            if "查無資料" in content or "請重新查詢" in content or len(content.strip()) == 0:
-                logging.warning(f"TPEx在 {date} 沒有數據")
-                return pd.DataFrame()
-            
-            # 手動解析CSV內容
-            lines = content.split('\n')
-            header_found = False
-            data_start = False
-            data_lines = []
-            
-            for i, line in enumerate(lines):
-                # 跳過空行
-                if not line.strip():
-                    continue
-                    
-                # 找到標題行
-                if not header_found and ("代號" in line and "名稱" in line and "收盤" in line):
-                    header_found = True
-                    data_lines.append(line)
-                    data_start = True
-                    continue
-                
-                # 收集數據行
-                if data_start:
-                    # 檢查是否到達數據結束
-                    if "總計" in line or "加權指數" in line:
-                        break
-                    # 確保這是有效的數據行 (通常以數字開頭)
-                    if re.match(r'^[0-9]{4,}', line.strip().split(',')[0].strip()):
-                        data_lines.append(line)
-            
-            # 如果沒有找到有效數據
-            if not header_found or len(data_lines) <= 1:
-                logging.warning(f"TPEx在 {date} 無法找到有效的股票數據")
-                return pd.DataFrame()
-            
-            # 手動解析CSV數據
-            csv_data = []
-            header = data_lines[0].split(',')
-            
-            # 找尋必要列的索引
-            try:
-                code_idx = 0  # 第一列通常是代號
-                name_idx = 1  # 第二列通常是名稱
-                close_idx = 2  # 第三列通常是收盤價
-            except ValueError:
-                logging.error(f"TPEx數據缺少必要的列: {header}")
-                return pd.DataFrame()
-            
-            # 解析數據行
-            for i in range(1, len(data_lines)):
-                fields = data_lines[i].split(',')
-                if len(fields) >= max(code_idx, name_idx, close_idx) + 1:
-                    stock_id = fields[code_idx].strip()
-                    # 確保這是有效的股票代碼
-                    if stock_id.isdigit():
-                        csv_data.append({
-                            'stock_id': stock_id,
-                            'stock_name': fields[name_idx].strip(),
-                            'close': fields[close_idx].strip().replace(',', '')
-                        })
-            
-            # 創建DataFrame
-            df = pd.DataFrame(csv_data)
-            
-            # 確保收盤價是數值型
-            df['close'] = pd.to_numeric(df['close'], errors='coerce')
-            
-            # 過濾掉非數值的行
-            df = df.dropna(subset=['close'])
-            
-            # 設置日期列
-            df['date'] = date
-            
-            return df
+            self.archive_response('tpex', date, content)
+            return self.attach_ex_reference('tpex', date, self.parse_tpex_content(content, date))
                 
         except Exception as e:
             logging.error(f"獲取TPEx數據時發生錯誤: {e}")
             return pd.DataFrame()
     
-    def fetch_data_for_date_range(self, start_date, end_date, max_retry=3):
-        """獲取指定日期範圍內的所有股票數據"""
+    def parse_twse_content(self, content, date):
+        """解析已解碼的TWSE每日收盤行情CSV內容"""
+        date_str = date.strftime('%Y%m%d')
+
+        # 尋找股票資料的部分
+        lines = content.split('\n')
+        start_idx = -1
+        for i, line in enumerate(lines):
+            if '"證券代號"' in line and '"證券名稱"' in line and '"收盤價"' in line:
+                start_idx = i
+                break
+
+        if start_idx == -1:
+            logging.error(f"無法找到 {date_str} 的TWSE股票數據表格")
+            return pd.DataFrame()
+
+        # 提取有效的資料行
+        data_lines = []
+        data_lines.append(lines[start_idx])  # 加入標題行
+
+        for line in lines[start_idx+1:]:
+            # 檢查行是否包含股票數據 (通常以數字開頭)
+            if line.strip() and re.match(r'^"[0-9]{4,}"', line.strip()):
+                data_lines.append(line)
+            elif line.strip() and '==================================' in line:
+                break  # 發現分隔線，表示數據結束
+
+        # 如果沒有數據，返回空DataFrame
+        if len(data_lines) <= 1:
+            logging.warning(f"TWSE在 {date_str} 未找到股票數據")
+            return pd.DataFrame()
+
+        # 手動解析CSV數據
+        csv_data = []
+        header = None
+
+        for i, line in enumerate(data_lines):
+            # 使用CSV模塊來正確處理CSV格式
+            reader = csv.reader(StringIO(line), delimiter=',', quotechar='"')
+            row = next(reader)
+
+            if i == 0:  # 這是標題行
+                header = [col.strip('"').strip() for col in row]
+                # 查找必要列的索引
+                try:
+                    code_idx = header.index('證券代號')
+                    name_idx = header.index('證券名稱')
+                    close_idx = header.index('收盤價')
+                except ValueError:
+                    logging.error(f"TWSE數據缺少必要的列: {header}")
+                    return pd.DataFrame()
+                # 漲跌欄位用於推算參考價 (除權息等公司行動)，缺少時不影響收盤價
+                sign_idx = header.index('漲跌(+/-)') if '漲跌(+/-)' in header else None
+                change_idx = header.index('漲跌價差') if '漲跌價差' in header else None
+                volume_idx = header.index('成交股數') if '成交股數' in header else None
+            else:
+                if len(row) >= max(code_idx, name_idx, close_idx) + 1:
+                    csv_data.append({
+                        'stock_id': row[code_idx].strip('"'),
+                        'stock_name': row[name_idx].strip('"'),
+                        'close': row[close_idx].strip('"').replace(',', ''),
+                        'change': self.parse_twse_change(row, sign_idx, change_idx),
+                        # 漲跌符號 X 為不比價 (除權息等)，參考價需另由除權息表取得
+                        'ca_marker': sign_idx is not None and len(row) > sign_idx and 'X' in row[sign_idx],
+                        'volume': row[volume_idx].strip('"').replace(',', '') if volume_idx is not None and len(row) > volume_idx else ''
+                    })
+
+        # 創建DataFrame
+        df = pd.DataFrame(csv_data)
+
+        # 確保收盤價是數值型
+        df['close'] = pd.to_numeric(df['close'], errors='coerce')
+        df['change'] = pd.to_numeric(df['change'], errors='coerce')
+        df['volume'] = pd.to_numeric(df['volume'], errors='coerce')
+
+        # 過濾掉非數值的行及特殊股票
+        df = df.dropna(subset=['close'])
+        df = df[df['stock_id'].str.isdigit()]  # 只保留數字股票代碼
+
+        # 設置日期列
+        df['date'] = date
+
+        return df
+
+    def parse_tpex_content(self, content, date):
+        """解析已解碼的TPEx每日收盤行情CSV內容"""
+        # 檢查是否有數據
+        if "查無資料" in content or "請重新查詢" in content or len(content.strip()) == 0:
+            logging.warning(f"TPEx在 {date} 沒有數據")
+            return pd.DataFrame()
+
+        # 手動解析CSV內容
+        lines = content.split('\n')
+        header_found = False
+        data_start = False
+        data_lines = []
+
+        for i, line in enumerate(lines):
+            # 跳過空行
+            if not line.strip():
+                continue
+
+            # 找到標題行
+            if not header_found and ("代號" in line and "名稱" in line and "收盤" in line):
+                header_found = True
+                data_lines.append(line)
+                data_start = True
+                continue
+
+            # 收集數據行
+            if data_start:
+                # 檢查是否到達數據結束
+                if "總計" in line or "加權指數" in line:
+                    break
+                # 確保這是有效的數據行 (通常以數字開頭)
+                if re.match(r'^[0-9]{4,}', line.strip().split(',')[0].strip()):
+                    data_lines.append(line)
+
+        # 如果沒有找到有效數據
+        if not header_found or len(data_lines) <= 1:
+            logging.warning(f"TPEx在 {date} 無法找到有效的股票數據")
+            return pd.DataFrame()
+
+        # 手動解析CSV數據
+        csv_data = []
+        header = data_lines[0].split(',')
+
+        # 找尋必要列的索引
+        try:
+            code_idx = 0  # 第一列通常是代號
+            name_idx = 1  # 第二列通常是名稱
+            close_idx = 2  # 第三列通常是收盤價
+            change_idx = 3  # 第四列通常是漲跌
+            volume_idx = 8  # 第九列通常是成交股數
+        except ValueError:
+            logging.error(f"TPEx數據缺少必要的列: {header}")
+            return pd.DataFrame()
+
+        # 解析數據行
+        for i in range(1, len(data_lines)):
+            fields = data_lines[i].split(',')
+            if len(fields) >= max(code_idx, name_idx, close_idx) + 1:
+                stock_id = fields[code_idx].strip()
+                # 確保這是有效的股票代碼
+                if stock_id.isdigit():
+                    csv_data.append({
+                        'stock_id': stock_id,
+                        'stock_name': fields[name_idx].strip(),
+                        'close': fields[close_idx].strip().replace(',', ''),
+                        # 第四列為漲跌，除權息等非數值內容會轉為NaN
+                        'change': fields[change_idx].strip().strip('"').replace('+', '') if len(fields) > change_idx else '',
+                        # 漲跌欄為除權、除息時，參考價需另由除權息表取得
+                        'ca_marker': len(fields) > change_idx and '除' in fields[change_idx],
+                        'volume': fields[volume_idx].strip().strip('"') if len(fields) > volume_idx else ''
+                    })
+
+        # 創建DataFrame
+        df = pd.DataFrame(csv_data)
+
+        # 確保收盤價是數值型
+        df['close'] = pd.to_numeric(df['close'], errors='coerce')
+        df['change'] = pd.to_numeric(df['change'], errors='coerce')
+        df['volume'] = pd.to_numeric(df['volume'], errors='coerce')
+
+        # 過濾掉非數值的行
+        df = df.dropna(subset=['close'])
+
+        # 設置日期列
+        df['date'] = date
+
+        return df
+
+    def archive_response(self, market, date, content):
+        """response_archive 有設定時保存原始回應，供黃金輸出比對使用"""
+        if not self.response_archive:
+            return
+        archive_dir = os.path.join(self.export_path, self.response_archive)
+        try:
+            os.makedirs(archive_dir, exist_ok=True)
+            with open(os.path.join(archive_dir, f"{market}_{date.strftime('%Y%m%d')}.csv"), 'w', encoding='utf-8') as f:
+                f.write(content)
+        except Exception as e:
+            logging.warning(f"保存原始回應時發生錯誤: {e}")
+    
+    def attach_ex_reference(self, market, date, df):
+        """有除權息標記的股票，由除權息表取得參考價 (ex_reference)，查無時為NaN"""
+        if df.empty or not df['ca_marker'].any():
+            return df
+        references = self.fetch_ex_reference(market, date)
+        df['ex_reference'] = df['stock_id'].map(references)
+        missing = int((df['ca_marker'] & df['ex_reference'].isna()).sum())
+        if missing:
+            logging.warning(f"{market.upper()}在 {date.strftime('%Y%m%d')} 有 {missing} 支除權息標記的股票查無參考價")
+        return df
+
+    def fetch_ex_reference(self, market, date):
+        """下載指定日期的除權息計算結果表 (TWSE TWT49U / TPEx 除權除息結果)，回傳 {股票代號: 參考價}"""
+        if market == 'twse':
+            date_str = date.strftime('%Y%m%d')
+            url = f"https://www.twse.com.tw/exchangeReport/TWT49U?response=csv&strDate={date_str}&endDate={date_str}"
+        else:
+            date_str = f"{date.year - 1911}/{date.month:02d}/{date.day:02d}"
+            url = f"https://www.tpex.org.tw/web/stock/exright/dailyquo/exDailyQ_result.php?l=zh-tw&d={date_str}&ed={date_str}&o=csv"
+
+        try:
+            response = requests.get(url, headers=self.headers)
+            response.raise_for_status()
+            for encoding in ['utf-8', 'big5', 'big5hkscs', 'cp950']:
+                try:
+                    return self.parse_ex_reference(response.content.decode(encoding))
+                except UnicodeDecodeError:
+                    continue
+            logging.error(f"無法解碼 {date_str} 的{market.upper()}除權息表")
+        except Exception as e:
+            logging.error(f"獲取{market.upper()}除權息表時發生錯誤: {e}")
+        return {}
+
+    def parse_ex_reference(self, content):
+        """依標題列找出代號與除權息參考價欄位，解析除權息計算結果表"""
+        references = {}
+        code_idx = ref_idx = None
+        for row in csv.reader(StringIO(content)):
+            row = [value.strip().lstrip('=').strip('"').strip() for value in row]
+            if code_idx is None:
+                code_col = next((col for col in ('股票代號', '代號') if col in row), None)
+                if code_col and '除權息參考價' in row:
+                    code_idx, ref_idx = row.index(code_col), row.index('除權息參考價')
+                continue
+            if len(row) > max(code_idx, ref_idx) and row[code_idx].isdigit():
+                reference = pd.to_numeric(row[ref_idx].replace(',', ''), errors='coerce')
+                if pd.notna(reference):
+                    references[row[code_idx]] = float(reference)
+        return references
+
+    def fetch_data_for_date_range(self, start_date, end_date, max_retry=3, skip=None):
+        """獲取指定日期範圍內的所有股票數據
+
+        skip 為已保存的 (日期, 市場) 集合，這些資料不會重複下載
+        """
         all_data = []
+        skip = skip or set()
         
         # 確保日期格式正確
         if isinstance(start_date, str):
@@ -367,63 +1159,37 @@ class TWStockAnalyzer:
         
         logging.info(f"從 {start_date.strftime('%Y-%m-%d')} 到 {end_date.strftime('%Y-%m-%d')} 預計有 {total_trading_days} 個交易日")
         
-        # 獲取每個交易日的數據
+        # 列出每個市場需要下載的交易日
+        pending = {'TWSE': [], 'TPEx': []}
         current_date = start_date
-        processed_days = 0
-        retry_dates = []  # 存儲需要重試的日期
-        
         while current_date <= end_date:
-            # 如果不是交易日，跳過
-            if not self.is_trading_day(current_date):
-                current_date += timedelta(days=1)
-                continue
-            
-            processed_days += 1
-            logging.info(f"[{processed_days}/{total_trading_days}] 獲取 {current_date.strftime('%Y-%m-%d')} 的數據...")
-            
-            # 獲取TWSE數據
-            twse_data = self.fetch_twse_data(current_date)
-            if not twse_data.empty:
-                logging.info(f"  - 成功獲取TWSE數據: {len(twse_data)}筆")
-                twse_data['market'] = 'TWSE'
-                all_data.append(twse_data)
-            else:
-                retry_dates.append((current_date, 'TWSE'))
-            
-            # 獲取TPEx數據
-            tpex_data = self.fetch_tpex_data(current_date)
-            if not tpex_data.empty:
-                logging.info(f"  - 成功獲取TPEx數據: {len(tpex_data)}筆")
-                tpex_data['market'] = 'TPEx'
-                all_data.append(tpex_data)
-            else:
-                retry_dates.append((current_date, 'TPEx'))
-            
-            # 加入延遲以避免過多請求
-            time.sleep(2)
-            
+            if self.is_trading_day(current_date):
+                for market in pending:
+                    if (current_date, market) not in skip:
+                        pending[market].append(current_date)
             current_date += timedelta(days=1)
+        for market, dates in pending.items():
+            logging.info(f"{market} 需要下載 {len(dates)} 個交易日，已保存 {total_trading_days - len(dates)} 個")
         
-        # 重試失敗的日期
-        if retry_dates and max_retry > 0:
-            logging.info(f"\n開始重試 {len(retry_dates)} 個失敗的請求...")
-            for retry_date, market in retry_dates:
-                logging.info(f"重試獲取 {retry_date.strftime('%Y-%m-%d')} 的 {market} 數據...")
-                
-                if market == 'TWSE':
-                    data = self.fetch_twse_data(retry_date)
-                    if not data.empty:
-                        logging.info(f"  - 重試成功獲取TWSE數據: {len(data)}筆")
-                        data['market'] = 'TWSE'
-                        all_data.append(data)
-                else:
-                    data = self.fetch_tpex_data(retry_date)
-                    if not data.empty:
-                        logging.info(f"  - 重試成功獲取TPEx數據: {len(data)}筆")
-                        data['market'] = 'TPEx'
-                        all_data.append(data)
-                
-                time.sleep(2)
+        # TWSE與TPEx為不同主機，各以一個執行緒依原本的間隔下載，解析完成的資料放入佇列；
+        # 目前的執行緒只將佇列中的資料收集成列表，兩個市場都下載完畢後才合併，
+        # 後續的資料檢查與計算不會與下載重疊
+        day_queue = queue.Queue()
+        fetchers = [threading.Thread(target=self.fetch_market_days, args=(market, dates, day_queue, max_retry), daemon=True)
+                    for market, dates in pending.items() if dates]
+        for fetcher in fetchers:
+            fetcher.start()
+        
+        finished = 0
+        while finished < len(fetchers):
+            day_data = day_queue.get()
+            if day_data is None:  # 該市場下載完畢
+                finished += 1
+                continue
+            all_data.append(day_data)
+        # 等待下載執行緒結束，之後 run_sharded fork 行程時不會有其他執行緒
+        for fetcher in fetchers:
+            fetcher.join()
         
         # 合併所有數據
         if all_data:
@@ -434,20 +1200,243 @@ class TWStockAnalyzer:
             logging.warning("未獲取到有效數據")
             return pd.DataFrame()
     
-    def calculate_moving_averages(self, data, windows=[5, 10, 20]):
-        """計算指定窗口的移動平均線"""
-        # 按股票ID和日期排序
-        data = data.sort_values(['stock_id', 'date'])
+    def fetch_market_days(self, market, dates, day_queue, max_retry=3):
+        """依序下載單一市場的多個交易日，每成功解析一天就放入佇列，結束時放入 None"""
+        fetch = self.fetch_twse_data if market == 'TWSE' else self.fetch_tpex_data
+        retry_dates = []  # 存儲需要重試的日期
+        try:
+            for i, current_date in enumerate(dates, 1):
+                logging.info(f"[{market} {i}/{len(dates)}] 獲取 {current_date.strftime('%Y-%m-%d')} 的數據...")
+                data = fetch(current_date)
+                if not data.empty:
+                    logging.info(f"  - 成功獲取{market}數據: {len(data)}筆")
+                    data['market'] = market
+                    day_queue.put(data)
+                else:
+                    retry_dates.append(current_date)
+                
+                # 加入延遲以避免過多請求
+                time.sleep(2)
+            
+            # 重試失敗的日期
+            if retry_dates and max_retry > 0:
+                logging.info(f"開始重試 {len(retry_dates)} 個失敗的{market}請求...")
+                for retry_date in retry_dates:
+                    logging.info(f"重試獲取 {retry_date.strftime('%Y-%m-%d')} 的 {market} 數據...")
+                    data = fetch(retry_date)
+                    if not data.empty:
+                        logging.info(f"  - 重試成功獲取{market}數據: {len(data)}筆")
+                        data['market'] = market
+                        day_queue.put(data)
+                    time.sleep(2)
+        except Exception as e:
+            logging.error(f"下載{market}數據時發生錯誤: {e}")
+        finally:
+            day_queue.put(None)
+    
+    def load_quote_store(self):
+        """載入已保存的報價資料 (已套用還原調整)"""
+        if not self.quote_store:
+            return pd.DataFrame()
+        store_file = os.path.join(self.export_path, self.quote_store)
+        if not os.path.exists(store_file):
+            return pd.DataFrame()
+        try:
+            store = pd.read_pickle(store_file)
+            logging.info(f"已載入保存的報價資料: {len(store)} 筆")
+            return store
+        except Exception as e:
+            logging.warning(f"讀取報價資料 {store_file} 時發生錯誤: {e}，將重新下載")
+            return pd.DataFrame()
+
+    def save_quote_store(self, store):
+        """保存報價資料，供下次執行時略過已下載的交易日"""
+        if not self.quote_store:
+            return
+        store_file = os.path.join(self.export_path, self.quote_store)
+        try:
+            store.to_pickle(store_file)
+            logging.info(f"報價資料已保存至 {store_file}")
+        except Exception as e:
+            logging.error(f"保存報價資料時發生錯誤: {e}")
+
+    def load_indicator_state(self):
+        """載入保存的 EMA/WMA 遞迴狀態，不存在或無法讀取時回傳 None"""
+        if not self.indicator_state:
+            return None
+        state_file = os.path.join(self.export_path, self.indicator_state)
+        if not os.path.exists(state_file):
+            return None
+        try:
+            state = pd.read_pickle(state_file)
+            logging.info(f"已載入EMA/WMA遞迴狀態: {len(state.keys)} 支股票，狀態日期 {state.last_date}")
+            return state
+        except Exception as e:
+            logging.warning(f"讀取遞迴狀態 {state_file} 時發生錯誤: {e}，將重新計算")
+            return None
+
+    def save_indicator_state(self, state):
+        """保存 EMA/WMA 遞迴狀態，供下次執行只計算新的交易日"""
+        if not self.indicator_state or state is None:
+            return
+        state_file = os.path.join(self.export_path, self.indicator_state)
+        try:
+            pd.to_pickle(state, state_file)
+        except Exception as e:
+            logging.error(f"保存遞迴狀態時發生錯誤: {e}")
+
+    def validate_quotes(self, data, store=None):
+        """以單次向量化運算檢查新報價的資料品質
+
+        移除重試造成的重複 (日期, 股票) 列，並標記缺漏的交易日 (gap_days)、
+        超過漲跌幅限制的價格跳動 (limit_breach)，以及參考價與前一收盤價
+        不連續 (ref_break，除權息、分割、減資) 的情形與對應的還原因子 (adj_factor)。
+        交易所標記為除權息 (ca_marker) 的列以除權息表的參考價 (ex_reference) 判斷，
+        查無參考價時標記為 ca_unresolved，不套用還原因子
+        """
+        before = len(data)
+        key = stock_key(data)
+        data = data.drop_duplicates(subset=['date', key], keep='last').copy()
+        duplicates = before - len(data)
+        data['raw_close'] = data['close']
+        for col, default in (('change', np.nan), ('ca_marker', False), ('ex_reference', np.nan)):
+            if col not in data.columns:
+                data[col] = default
+
+        # 新資料與保存資料合併後，每一列與同一支股票的前一列比較；
+        # 補抓較早的交易日時，其後的新資料仍與中間保存的交易日比較
+        calendar_dates = data['date'].unique()
+        context = pd.DataFrame()
+        if store is not None and not store.empty:
+            calendar_dates = np.union1d(calendar_dates, store['date'].unique())
+            context = store.loc[store[key].isin(data[key]) & (store['date'] <= data['date'].max()),
+                                [key, 'date', 'raw_close']]
+            # 同一 (日期, 股票) 以新資料為準
+            replaced = pd.MultiIndex.from_frame(context[[key, 'date']]).isin(
+                pd.MultiIndex.from_frame(data[[key, 'date']]))
+            context = context[~replaced]
+        # 加入交易日曆，整個市場都缺漏 (未抓到) 的交易日也能計入 gap_days
+        fetched_dates = np.asarray(pd.DatetimeIndex(calendar_dates), dtype='datetime64[ns]')
+        trading_days = [day for day in pd.date_range(fetched_dates.min(), fetched_dates.max())
+                        if self.is_trading_day(day.to_pydatetime())]
+        calendar_dates = np.union1d(fetched_dates, np.asarray(trading_days, dtype='datetime64[ns]'))
+        # 至各交易日為止未抓到的交易日數，用於判斷兩列之間是否有整個市場缺漏的交易日
+        unfetched = np.cumsum(~np.isin(calendar_dates, fetched_dates))
+
+        frame = data.assign(is_context=False)
+        if not context.empty:
+            frame = pd.concat([context.assign(is_context=True), frame], ignore_index=True)
+        frame = frame.sort_values([key, 'date'], kind='mergesort').reset_index(drop=True)
+
+        # 排序後同一支股票的前一列即為前一個有資料的交易日
+        stock_ids = frame[key].to_numpy()
+        has_prev = np.r_[False, stock_ids[1:] == stock_ids[:-1]]
+        raw_close = frame['raw_close'].to_numpy(dtype=float)
+        positions = np.searchsorted(calendar_dates, frame['date'].to_numpy(dtype='datetime64[ns]'))
+        prev_close = np.where(has_prev, np.r_[np.nan, raw_close[:-1]], np.nan)
+        gap_days = np.where(has_prev, positions - np.r_[0, positions[:-1]] - 1, 0)
+        market_gap = has_prev & (unfetched[positions] != np.r_[0, unfetched[positions[:-1]]])
+
+        # 參考價 = 收盤價 - 漲跌；除權息標記的列改用除權息表的參考價。
+        # 與前一收盤價不一致即表示有公司行動
+        ca_marker = frame['ca_marker'].eq(True).to_numpy()
+        ex_reference = frame['ex_reference'].to_numpy(dtype=float)
+        reference = np.where(ca_marker & ~np.isnan(ex_reference), ex_reference,
+                             raw_close - frame['change'].to_numpy(dtype=float))
+        ca_unresolved = has_prev & ca_marker & np.isnan(ex_reference)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # 漲跌相對於前一個交易日的收盤價，個股停牌後則相對於恢復交易的參考價，
+            # 因此停牌後 (分割、減資) 仍與該股票最後的收盤價比較；只有中間有整個市場
+            # 都未抓到的交易日時，無法得知漲跌所依據的價格而不判斷
+            ref_break = has_prev & ~market_gap & (reference > 0) & (np.abs(reference - prev_close) > 0.005)
+            base = np.where(np.isnan(reference), prev_close, reference)
+            limit_breach = np.abs(raw_close / base - 1) > self.price_limit + 0.001
+            adj_factor = np.where(ref_break, reference / prev_close, 1.0)
+
+        frame['gap_days'] = gap_days
+        frame['limit_breach'] = limit_breach
+        frame['ref_break'] = ref_break
+        frame['adj_factor'] = adj_factor
+        frame['ca_marker'] = ca_marker
+        frame['ca_unresolved'] = ca_unresolved
+
+        checked = frame[~frame['is_context'].astype(bool)].drop(columns='is_context').reset_index(drop=True)
+        logging.info(f"資料品質檢查: 重複列 {duplicates} 筆、缺漏交易日 {int((checked['gap_days'] > 0).sum())} 筆、"
+                     f"超過漲跌幅限制 {int(checked['limit_breach'].sum())} 筆、參考價不連續 {int(checked['ref_break'].sum())} 筆")
+        unresolved = int(checked['ca_unresolved'].sum())
+        if unresolved:
+            logging.warning(f"有 {unresolved} 筆除權息標記查無參考價，未偵測公司行動也未套用還原因子 (ca_unresolved)")
+        return checked
+
+    def update_quote_store(self, store, checked, record=True):
+        """將檢查後的新報價併入保存資料，只對受影響的股票與日期套用還原因子
+
+        重新併入已保存的 (股票, 日期) 時，收盤價沿用其後公司行動的累積還原因子，
+        且只套用與先前因子的差異，重複併入相同的報價不會再次調整或重複記錄。
+        record 為 False 時不寫入 corporate_actions.csv (供不保存報價的資料集使用)
+        """
+        key = stock_key(checked)
+        factors = np.where(checked['ref_break'], checked['adj_factor'], 1.0)
+        if not store.empty:
+            stored = checked[[key, 'date']].merge(
+                store[[key, 'date', 'close', 'raw_close', 'ref_break', 'adj_factor']],
+                on=[key, 'date'], how='left')
+            checked = checked.copy()
+            unchanged = (stored['raw_close'] == checked['raw_close'].to_numpy()).to_numpy()
+            checked['close'] = np.where(unchanged, stored['close'],
+                                        checked['raw_close'] * (stored['close'] / stored['raw_close']).fillna(1.0))
+            factors = factors / np.where(stored['ref_break'].eq(True), stored['adj_factor'], 1.0)
+        combined = pd.concat([store, checked], ignore_index=True) if not store.empty else checked.copy()
+        combined = combined.drop_duplicates(subset=['date', key], keep='last').reset_index(drop=True)
+
+        changed = ~np.isclose(factors, 1.0)
+        events = checked.loc[changed, [key, 'date']].assign(adj_factor=factors[changed])
+        if not events.empty:
+            combined = self.apply_adjustments(combined, events)
+            if record:
+                self.record_corporate_actions(events)
+        return combined
+
+    def apply_adjustments(self, data, events):
+        """以還原因子向前調整除權日之前的收盤價，只處理有事件的股票"""
+        # 每支股票由最後一個事件往前累乘，得到各期間的累積還原因子
+        key = stock_key(events)
+        events = events.sort_values([key, 'date'])
+        events = events.assign(cum_factor=events.iloc[::-1].groupby(key)['adj_factor'].cumprod())
+
+        # 每一列對應到日期之後的第一個事件，套用其累積因子
+        rows = data.loc[data[key].isin(events[key]), [key, 'date']]
+        rows = rows.reset_index().sort_values('date')
+        matched = pd.merge_asof(rows, events[[key, 'date', 'cum_factor']].sort_values('date'),
+                                on='date', by=key, direction='forward', allow_exact_matches=False)
+        factors = matched.set_index('index')['cum_factor'].dropna()
+
+        data.loc[factors.index, 'close'] = data.loc[factors.index, 'close'] * factors
+        logging.info(f"已對 {events[key].nunique()} 支股票的 {len(factors)} 筆歷史價格套用還原因子")
+        return data
+
+    def record_corporate_actions(self, events):
+        """將偵測到的公司行動 (還原因子) 附加至紀錄檔"""
+        ledger_file = os.path.join(self.export_path, 'corporate_actions.csv')
+        ledger = self.with_symbols(events).rename(columns={'date': 'ex_date', 'adj_factor': 'factor'})
+        ledger = ledger[['stock_id', 'ex_date', 'factor']]
+        try:
+            ledger.to_csv(ledger_file, mode='a', index=False, header=not os.path.exists(ledger_file),
+                          encoding='utf_8_sig')
+        except Exception as e:
+            logging.error(f"寫入公司行動紀錄時發生錯誤: {e}")
+    
+    def calculate_moving_averages(self, data, windows=DEFAULT_MA_WINDOWS, workers=None):
+        """計算指定窗口的移動平均線，workers 未指定時使用設定檔的 workers"""
+        # 按股票ID (或整數鍵) 和日期排序
+        key = stock_key(data)
+        data = data.sort_values([key, 'date'])
         
         # 創建結果DataFrame的副本
         result = data.copy()
         
-        # 初始化MA列
-        for window in windows:
-            result[f'MA{window}'] = np.nan
-        
         # 檢查數據量
-        stock_dates = data.groupby('stock_id')['date'].nunique()
+        stock_dates = data.groupby(key)['date'].nunique()
         logging.info(f"數據中包含的股票數量: {len(stock_dates)}")
         logging.info(f"每支股票的平均交易日數: {stock_dates.mean():.2f}")
         logging.info(f"最小交易日數: {stock_dates.min()}, 最大交易日數: {stock_dates.max()}")
@@ -457,44 +1446,137 @@ class TWStockAnalyzer:
         max_date = data['date'].max()
         logging.info(f"數據日期範圍: {min_date} 到 {max_date}")
         
-        # 計算每支股票的均線
-        stocks_with_insufficient_data = []
-        stock_groups = data.groupby('stock_id')
-        total_stocks = len(data['stock_id'].unique())
-        processed = 0
-        
-        for stock_id, stock_data in stock_groups:
-            # 對每個窗口計算移動平均線
-            stock_df = stock_data.sort_values('date')
-            days_count = len(stock_df)
-            
-            for window in windows:
-                ma_col = f'MA{window}'
-                if days_count < window:
-                    # 記錄數據不足的股票
-                    if stock_id not in stocks_with_insufficient_data:
-                        stocks_with_insufficient_data.append(stock_id)
-                    # 使用完整的window值，但確保min_periods設為window
-                    # 這樣在數據不足時會產生NaN而不是部分計算的值
-                    result.loc[stock_df.index, ma_col] = np.nan
-                else:
-                    # 確保計算正確，設置min_periods=window
-                    ma_values = stock_df['close'].rolling(window=window, min_periods=window).mean()
-                    result.loc[stock_df.index, ma_col] = ma_values.values
-            
-            processed += 1
-            if processed % 100 == 0 or processed == total_stocks:
-                logging.info(f"已處理 {processed}/{total_stocks} 支股票的均線計算")
+        # 依股票邊界切分後計算每支股票的均線 (workers > 1 時以多行程平行計算)
+        if workers is None:
+            workers = self.workers
+        codes = pd.factorize(result[key])[0]
+        ma_values = run_sharded(rolling_mean_kernel, result['close'].to_numpy(dtype=float), codes,
+                                list(windows), len(windows), workers)
+        for i, window in enumerate(windows):
+            # min_periods=window，數據不足時會產生NaN而不是部分計算的值
+            result[f'MA{window}'] = ma_values[:, i]
         
-        if stocks_with_insufficient_data:
+        # 記錄數據不足的股票
+        stock_rows = result.groupby(key).size()
+        stocks_with_insufficient_data = stock_rows[stock_rows < max(windows, default=0)]
+        if not stocks_with_insufficient_data.empty:
             logging.warning(f"警告: {len(stocks_with_insufficient_data)} 支股票的數據少於 {max(windows)} 個交易日")
             logging.warning(f"這些股票的均線計算可能不准確或為NaN")
-        
+
         logging.info("移動平均線計算完成")
         return result
-    
-    def filter_stocks(self, data, date1, date2):
-        """篩選符合條件的股票"""
+
+    def calculate_recursive_averages(self, data, ema_windows=(), wma_windows=(), workers=None):
+        """以遞迴濾波計算整段歷史的 EMA 與 WMA，回傳 (含指標欄位的資料, 遞迴狀態)
+
+        每一步同時更新所有股票，workers > 1 時沿股票邊界以多行程平行計算；
+        回傳的狀態可交給 advance_recursive_averages 繼續逐日更新
+        """
+        key = stock_key(data)
+        result = data.sort_values([key, 'date']).copy()
+        state = RecursiveAverages(ema_windows, wma_windows)
+        if workers is None:
+            workers = self.workers
+
+        codes, keys = pd.factorize(result[key])
+        closes = result['close'].to_numpy(dtype=float)
+        raw = run_sharded(recursive_average_kernel, closes, codes, (state.ema_windows, state.wma_windows),
+                          len(state.columns), workers)
+        state.load_history(keys, codes, closes, raw)
+        state.last_date = result['date'].max() if not result.empty else None
+
+        seq = result.groupby(key, sort=False).cumcount().to_numpy()
+        result[state.columns] = state.mask_warmup(raw, seq + 1)
+        logging.info(f"已以遞迴濾波計算 {len(keys)} 支股票的 {', '.join(state.columns)}")
+        return result, state
+
+    def advance_recursive_averages(self, state, data):
+        """以遞迴狀態逐日計算新資料的 EMA 與 WMA，每個交易日只需 O(股票數) 的運算
+
+        data 只能包含晚於 state.last_date 的交易日；state 會就地更新，回傳加上指標欄位的資料
+        """
+        key = stock_key(data)
+        result = data.sort_values(['date', key]).copy()
+        values = np.empty((len(result), len(state.columns)))
+        keys = result[key].to_numpy()
+        closes = result['close'].to_numpy(dtype=float)
+        dates = result['date'].to_numpy()
+
+        bounds = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1], True]) if len(dates) else []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            idx = state.positions(keys[start:stop])
+            values[start:stop] = state.mask_warmup(state.advance(idx, closes[start:stop]), state.count[idx])
+            state.last_date = pd.Timestamp(dates[start])
+
+        result[state.columns] = values
+        return result
+
+    def update_recursive_averages(self, store, checked, state, ema_windows=(), wma_windows=()):
+        """維護報價資料中的 EMA/WMA 欄位，回傳 (報價資料, 遞迴狀態)
+
+        晚於狀態日期的新交易日以遞迴狀態逐日更新；有還原調整或補抓較早日期的股票
+        只重新計算該股票的整段歷史；窗口改變或狀態與報價資料不一致時才全部重新計算
+        """
+        columns = RecursiveAverages(ema_windows, wma_windows).columns
+        if not columns or store.empty:
+            return store, state
+
+        key = stock_key(store)
+        if checked is None:
+            checked = store.iloc[0:0]
+        if (state is None or state.columns != columns or state.last_date is None
+                or not set(columns).issubset(store.columns)
+                or (store['date'] > state.last_date).sum() != (checked['date'] > state.last_date).sum()):
+            logging.info("重新計算所有股票的EMA/WMA歷史")
+            result, state = self.calculate_recursive_averages(store.drop(columns=columns, errors='ignore'),
+                                                              ema_windows, wma_windows)
+            return result.sort_index(), state
+
+        # 有還原調整或補抓較早日期的股票需重新計算整段歷史
+        events = checked.loc[checked['ref_break'], key] if 'ref_break' in checked.columns else checked[key].iloc[0:0]
+        recompute = pd.Index(events).union(pd.Index(checked.loc[checked['date'] <= state.last_date, key])).unique()
+        if len(recompute):
+            subset = store.loc[store[key].isin(recompute)].drop(columns=columns)
+            partial, partial_state = self.calculate_recursive_averages(subset, ema_windows, wma_windows)
+            store.loc[partial.index, columns] = partial[columns]
+            state.replace(partial_state)
+
+        # 其餘股票的新交易日由保存的狀態向前推進
+        latest = store['date'].max()
+        pending = (store['date'] > state.last_date) & ~store[key].isin(recompute)
+        if pending.any():
+            advanced = self.advance_recursive_averages(state, store.loc[pending].drop(columns=columns))
+            store.loc[advanced.index, columns] = advanced[columns]
+            logging.info(f"已以遞迴狀態更新 {int(pending.sum())} 筆新報價的 {', '.join(columns)}")
+        state.last_date = max(state.last_date, latest)
+        return store, state
+
+    def calculate_crossovers(self, data, pairs):
+        """對整段歷史一次標記均線交叉，欄位 CROSS_{快線}_{慢線}：1 為黃金交叉、-1 為死亡交叉、0 為無
+
+        與同一支股票在資料中前一個交易日的值比較：快線由不高於慢線變為高於慢線即為黃金交叉，反之為死亡交叉；
+        該股票前一個交易日沒有資料 (停牌、尚未上市) 時不標記交叉，與 StockPanel.compute_signals 相同
+        """
+        key = stock_key(data)
+        result = data.sort_values([key, 'date']).copy()
+        stock_ids = result[key].to_numpy()
+        positions = np.searchsorted(np.sort(result['date'].unique()), result['date'].to_numpy())
+        has_prev = np.r_[False, (stock_ids[1:] == stock_ids[:-1]) & (positions[1:] == positions[:-1] + 1)]
+        for fast, slow in pairs:
+            diff = result[fast].to_numpy(dtype=float) - result[slow].to_numpy(dtype=float)
+            prev = np.r_[np.nan, diff[:-1]]
+            golden = has_prev & (prev <= 0) & (diff > 0)
+            death = has_prev & (prev >= 0) & (diff < 0)
+            result[f'CROSS_{fast}_{slow}'] = np.where(golden, 1, np.where(death, -1, 0)).astype(np.int8)
+        return result
+
+    def filter_stocks(self, data, date1, date2, windows=DEFAULT_MA_WINDOWS, condition='breakthrough',
+                      averages=None, fast=None, slow=None):
+        """篩選符合條件的股票
+
+        突破/跌破比較收盤價與 averages (未指定時為 windows 的簡單均線) 的關係；
+        黃金/死亡交叉以 calculate_crossovers 標記的快線 fast 與慢線 slow 在第二日的交叉為準
+        """
         if data.empty:
             logging.warning("沒有數據可供篩選")
             return pd.DataFrame()
@@ -507,65 +1589,139 @@ class TWStockAnalyzer:
         
         logging.info(f"開始篩選符合條件的股票...")
         logging.info(f"可用日期範圍: {data['date'].min()} 到 {data['date'].max()}")
+
+        # 突破：第一日低於均線、第二日高於均線；跌破則相反。交叉比較的是快線與慢線
+        above_on_date2 = condition in ('breakthrough', 'golden_cross')
+        cross = condition in CROSS_CONDITIONS
+        if cross:
+            ma_cols = [fast, slow]
+            cross_col = f'CROSS_{fast}_{slow}'
+            if cross_col not in data.columns:
+                data = self.calculate_crossovers(data, [(fast, slow)])
+            label = f"{fast}/{slow}{'黃金交叉' if above_on_date2 else '死亡交叉'}"
+        else:
+            ma_cols = list(averages) if averages is not None else [f'MA{window}' for window in windows]
+            label = f"均線{'突破' if above_on_date2 else '跌破'}"
         
-        # 第一個日期：收盤價低於均線
-        date1_data = data[data['date'] == date1].copy()
+        # 第一個日期：收盤價與均線的關係
+        date1_data = data[data['date'] == date1]
         if date1_data.empty:
             logging.warning(f"警告：找不到 {date1.strftime('%Y-%m-%d')} 的數據")
             return pd.DataFrame()
             
-        date1_filtered = date1_data[(date1_data['close'] < date1_data['MA5']) & 
-                                   (date1_data['close'] < date1_data['MA10']) &
-                                   (date1_data['close'] < date1_data['MA20'])]
-        logging.info(f"找到 {len(date1_filtered)} 支股票在 {date1.strftime('%Y-%m-%d')} 收盤價低於均線")
+        if cross:
+            # 交叉已比較前一筆資料，第一日只需有資料
+            date1_filtered = date1_data
+        else:
+            date1_filtered = date1_data[self.compare_close_with_ma(date1_data, ma_cols, above=not above_on_date2)]
+            logging.info(f"找到 {len(date1_filtered)} 支股票在 {date1.strftime('%Y-%m-%d')} 收盤價{'低於' if above_on_date2 else '高於'}均線")
         
-        # 第二個日期：收盤價高於均線
-        date2_data = data[data['date'] == date2].copy()
+        # 第二個日期：收盤價與均線的關係
+        date2_data = data[data['date'] == date2]
         if date2_data.empty:
             logging.warning(f"警告：找不到 {date2.strftime('%Y-%m-%d')} 的數據")
             return pd.DataFrame()
             
-        date2_filtered = date2_data[(date2_data['close'] > date2_data['MA5']) & 
-                                   (date2_data['close'] > date2_data['MA10']) &
-                                   (date2_data['close'] > date2_data['MA20'])]
-        logging.info(f"找到 {len(date2_filtered)} 支股票在 {date2.strftime('%Y-%m-%d')} 收盤價高於均線")
+        if cross:
+            date2_filtered = date2_data[date2_data[cross_col] == (1 if above_on_date2 else -1)]
+            logging.info(f"找到 {len(date2_filtered)} 支股票在 {date2.strftime('%Y-%m-%d')} 出現{label}")
+        else:
+            date2_filtered = date2_data[self.compare_close_with_ma(date2_data, ma_cols, above=above_on_date2)]
+            logging.info(f"找到 {len(date2_filtered)} 支股票在 {date2.strftime('%Y-%m-%d')} 收盤價{'高於' if above_on_date2 else '低於'}均線")
         
-        # 找出同時符合兩個條件的股票
-        common_stocks = set(date1_filtered['stock_id']).intersection(set(date2_filtered['stock_id']))
-        logging.info(f"找到 {len(common_stocks)} 支股票符合均線突破條件")
+        # 以股票代號 (或整數鍵) 合併兩個日期的結果，找出同時符合兩個條件的股票
+        key = stock_key(data)
+        date1_str = date1.strftime("%Y%m%d")
+        date2_str = date2.strftime("%Y%m%d")
+        value_cols = ['close'] + ma_cols
+
+        left = date1_filtered.drop_duplicates(key)[[key] + value_cols]
+        left = left.rename(columns={col: f'{col}_{date1_str}' for col in value_cols})
+        # 名稱與市場以第二個日期 (最新) 為準
+        info_cols = [key] if key == 'sid' else [key, 'stock_name', 'market']
+        right = date2_filtered.drop_duplicates(key)[info_cols + value_cols]
+        right = right.rename(columns={col: f'{col}_{date2_str}' for col in value_cols})
+
+        result = left.merge(right, on=key, how='inner').reset_index(drop=True)
+        result = self.with_symbols(result, date2)
+        result = result[['stock_id', 'stock_name', 'market'] +
+                        [f'{col}_{date1_str}' for col in value_cols] + [f'{col}_{date2_str}' for col in value_cols]]
+        logging.info(f"找到 {len(result)} 支股票符合{label}條件")
         
         # 如果沒有找到符合條件的股票
-        if not common_stocks:
+        if result.empty:
             return pd.DataFrame()
         
-        # 獲取這些股票的詳細信息
-        result = []
-        for stock_id in common_stocks:
-            try:
-                stock_info_date1 = date1_filtered[date1_filtered['stock_id'] == stock_id].iloc[0]
-                stock_info_date2 = date2_filtered[date2_filtered['stock_id'] == stock_id].iloc[0]
-                
-                result.append({
-                    'stock_id': stock_id,
-                    'stock_name': stock_info_date1['stock_name'],
-                    'market': stock_info_date1['market'],
-                    f'close_{date1.strftime("%Y%m%d")}': stock_info_date1['close'],
-                    f'MA5_{date1.strftime("%Y%m%d")}': stock_info_date1['MA5'],
-                    f'MA10_{date1.strftime("%Y%m%d")}': stock_info_date1['MA10'],
-                    f'MA20_{date1.strftime("%Y%m%d")}': stock_info_date1['MA20'],
-                    f'close_{date2.strftime("%Y%m%d")}': stock_info_date2['close'],
-                    f'MA5_{date2.strftime("%Y%m%d")}': stock_info_date2['MA5'],
-                    f'MA10_{date2.strftime("%Y%m%d")}': stock_info_date2['MA10'],
-                    f'MA20_{date2.strftime("%Y%m%d")}': stock_info_date2['MA20']
-                })
-            except IndexError:
-                logging.warning(f"警告：處理股票 {stock_id} 時出現索引錯誤，可能是數據不完整")
-                continue
-        
-        return pd.DataFrame(result)
+        return result
+
+    def with_symbols(self, data, date=None):
+        """資料以整數鍵 sid 表示時，轉回代號、名稱 (指定日期的名稱) 與市場欄位"""
+        if 'sid' not in data.columns:
+            return data
+        return self.symbols.decode(data, date)
+
+    def compare_close_with_ma(self, data, ma_cols, above=True):
+        """回傳收盤價是否同時高於 (或低於) 所有指定均線的布林遮罩"""
+        mask = pd.Series(True, index=data.index)
+        for ma_col in ma_cols:
+            if above:
+                mask &= data['close'] > data[ma_col]
+            else:
+                mask &= data['close'] < data[ma_col]
+        return mask
+
+    def holding_mask(self, data, profile):
+        """回傳策略設定組的訊號是否仍成立：突破/跌破為收盤價仍在所有均線同側，交叉為快線仍在慢線同側"""
+        if profile['condition'] in CROSS_CONDITIONS:
+            if profile['condition'] == 'golden_cross':
+                return data[profile['fast']] > data[profile['slow']]
+            return data[profile['fast']] < data[profile['slow']]
+        return self.compare_close_with_ma(data, profile['averages'], above=profile['condition'] == 'breakthrough')
+
+    def required_averages(self, profiles):
+        """所有策略設定組需要的均線窗口聯集，依種類 (MA、EMA、WMA) 分組"""
+        needed = {'MA': set(), 'EMA': set(), 'WMA': set()}
+        for profile in profiles:
+            names = list(profile['averages'])
+            if profile['condition'] in CROSS_CONDITIONS:
+                names += [profile['fast'], profile['slow']]
+            if profile['rank_by'] == 'ma20_distance_pct':
+                names.append('MA20')
+            for name in names:
+                kind, window = AVERAGE_PATTERN.match(name).groups()
+                needed[kind].add(int(window))
+        return {kind: sorted(windows) for kind, windows in needed.items()}
+
+    def panel(self, start_date=None, end_date=None, data=None, cache_size=8):
+        """建立延遲計算並快取結果的資料集 (StockPanel)
+
+        未提供 data 時，第一次存取才下載 start_date 至 end_date 的資料
+        (預設為最近的交易日往前約60個交易日)
+        """
+        if data is not None:
+            return StockPanel(self, lambda: data, cache_size=cache_size)
+
+        if end_date is None:
+            end_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            while not self.is_trading_day(end_date):
+                end_date = end_date - timedelta(days=1)
+        if start_date is None:
+            start_date = self.calculate_start_date(end_date)
+        return StockPanel(self, lambda: self.fetch_data_for_date_range(start_date, end_date), cache_size=cache_size)
     
-    def run_analysis(self, output_file=None):
-        """執行完整的分析流程，自動使用當天和前一個交易日"""
+    def run_analysis(self, profiles=None, deliver=None):
+        """執行完整的分析流程，自動使用當天和前一個交易日
+
+        資料只抓取一次、均線只計算一次 (取所有策略設定組所需窗口的聯集)，
+        再依各策略設定組分別篩選並輸出，回傳 {組名: (篩選結果, PDF路徑, CSV路徑, 變化報告路徑)}。
+        deliver(profile, result) 會在該組的輸出完成後立即於背景呼叫 (例如寄送郵件)
+        """
+        if profiles is None:
+            profiles = self.profiles
+        if not profiles:
+            logging.error("沒有可用的策略設定組，分析終止")
+            return {}
+
         # 獲取當前日期和前一個交易日
         today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         
@@ -581,65 +1737,307 @@ class TWStockAnalyzer:
         previous_trading_day = self.get_previous_trading_day(today)
         
         logging.info(f"分析日期: 今天 {today.strftime('%Y-%m-%d')} 和前一交易日 {previous_trading_day.strftime('%Y-%m-%d')}")
+
+        # 所有策略設定組需要的均線窗口聯集
+        needed = self.required_averages(profiles)
+        windows = needed['MA']
+        pairs = sorted({(p['fast'], p['slow']) for p in profiles if p['condition'] in CROSS_CONDITIONS})
+        logging.info(f"策略設定組: {', '.join(p['name'] for p in profiles)}，需要的均線: "
+                     f"{', '.join(f'{kind}{windows}' for kind, windows in needed.items() if windows)}")
         
-        # 自動計算起始日期，確保有足夠的交易日計算MA20
-        start_date = self.calculate_start_date(today, days_needed=60)  # 約三個月60個交易日
+        # 自動計算起始日期，確保有足夠的交易日計算最長的均線
+        longest = max(w for kind_windows in needed.values() for w in kind_windows)
+        start_date = self.calculate_start_date(today, days_needed=max(60, longest + 10))  # 至少約三個月60個交易日
         logging.info(f"自動計算的起始日期: {start_date.strftime('%Y-%m-%d')}")
         
-        # 產生輸出檔案名稱
-        if output_file is None:
-            date_str = today.strftime('%Y%m%d')
-            output_file = os.path.join(
-                self.export_path, 
-                self.export_filename.format(date=date_str)
-            )
-        
+        # 載入保存的報價資料，只下載尚未保存的交易日
+        store = self.load_quote_store()
+        migrated = not store.empty and 'sid' not in store.columns
+        if migrated:
+            # 舊格式的報價資料：以代號建立主檔後轉為整數鍵
+            self.symbols.update(store)
+            store = self.symbols.intern(store)
+        elif not store.empty and store['sid'].max() >= len(self.symbols):
+            logging.warning("報價資料與股票主檔不一致，將重新下載")
+            store = pd.DataFrame()
+        skip = set()
+        if not store.empty:
+            stored = store[['date', 'sid']].drop_duplicates()
+            skip = set(zip(stored['date'], self.symbols.markets_of(stored['sid'])))
+
         # 獲取歷史數據
         logging.info("開始獲取歷史數據...")
-        data = self.fetch_data_for_date_range(start_date, today)
+        new_data = self.fetch_data_for_date_range(start_date, today, skip=skip)
+
+        # 更新股票主檔，資料只保留整數鍵，再檢查資料品質並以還原因子調整歷史價格
+        checked = None
+        if not new_data.empty:
+            self.symbols.update(new_data)
+            new_data = self.symbols.intern(new_data)
+            checked = self.validate_quotes(new_data, store)
+            store = self.update_quote_store(store, checked)
+
+        # EMA/WMA 以保存的遞迴狀態只計算新的交易日，並保存在報價資料中
+        saved_state = self.load_indicator_state()
+        store, indicator_state = self.update_recursive_averages(store, checked, saved_state,
+                                                                needed['EMA'], needed['WMA'])
+
+        data = pd.DataFrame()
+        if not store.empty:
+            data = store[(store['date'] >= start_date) & (store['date'] <= today)].reset_index(drop=True)
         
         if data.empty:
             logging.error("未獲取到有效數據，分析終止")
-            return None
-        
-        # 儲存原始數據以備後用
-        raw_data_file = os.path.join(self.export_path, f'raw_stock_data_{today.strftime("%Y%m%d")}.csv')
-        data.to_csv(raw_data_file, index=False, encoding='utf_8_sig')
-        logging.info(f"原始數據已保存至 {raw_data_file}")
+            return {}
         
-        # 計算移動平均線
+        # 計算移動平均線：須在啟動輸出執行緒之前完成，workers > 1 時 run_sharded 會 fork 行程，
+        # 若其他執行緒正持有 logging、pickle 或檔案 I/O 的鎖，子行程可能死結
         logging.info("計算移動平均線...")
-        data_with_ma = self.calculate_moving_averages(data)
-        
-        # 儲存含MA的數據以備後用
-        ma_data_file = os.path.join(self.export_path, f'stock_data_with_ma_{today.strftime("%Y%m%d")}.csv')
-        data_with_ma.to_csv(ma_data_file, index=False, encoding='utf_8_sig')
-        logging.info(f"含均線的數據已保存至 {ma_data_file}")
-        
-        # 篩選符合條件的股票
-        logging.info("篩選符合條件的股票...")
-        filtered_stocks = self.filter_stocks(data_with_ma, previous_trading_day, today)
+        data_with_ma = self.calculate_moving_averages(data, windows=windows)
+        if pairs:
+            data_with_ma = self.calculate_crossovers(data_with_ma, pairs)
+
+        # 輸出階段以執行緒池並行：CSV/欄式匯出、圖表繪製與郵件寄送彼此重疊，
+        # 並與各策略設定組的篩選同時進行
+        with ThreadPoolExecutor(max_workers=self.output_workers) as executor:
+            exports = []
+            # 整數鍵的報價資料必須與股票主檔一起保存，否則下次載入時無法對應
+            if not new_data.empty or migrated or indicator_state is not saved_state:
+                exports.append(executor.submit(self.symbols.save))
+                exports.append(executor.submit(self.save_quote_store, store))
+                exports.append(executor.submit(self.save_indicator_state, indicator_state))
+
+            # 儲存原始數據以備後用
+            raw_data_file = os.path.join(self.export_path, f'raw_stock_data_{today.strftime("%Y%m%d")}.csv')
+            exports.append(executor.submit(self.export_frame, data, raw_data_file, "原始數據"))
+            
+            # 儲存含MA的數據以備後用
+            ma_data_file = os.path.join(self.export_path, f'stock_data_with_ma_{today.strftime("%Y%m%d")}.csv')
+            exports.append(executor.submit(self.export_frame, data_with_ma, ma_data_file, "含均線的數據",
+                                           columnar=self.columnar_export))
+            
+            # 依各策略設定組篩選符合條件的股票，輸出與寄送交由執行緒池處理
+            futures = {}
+            for profile in profiles:
+                futures[profile['name']] = self.run_profile(profile, data_with_ma, previous_trading_day, today,
+                                                            executor, deliver=deliver)
+
+            results = {name: future.result() for name, future in futures.items()}
+            for export in exports:
+                export.result()
+        return results
+
+    def export_frame(self, data, csv_file, label, columnar=False):
+        """將DataFrame匯出為CSV，columnar 為 True 時另存同名的 Parquet 欄式檔案"""
+        data = self.with_symbols(data)
+        data.to_csv(csv_file, index=False, encoding='utf_8_sig')
+        logging.info(f"{label}已保存至 {csv_file}")
+        if columnar:
+            parquet_file = os.path.splitext(csv_file)[0] + '.parquet'
+            try:
+                data.to_parquet(parquet_file, index=False)
+                logging.info(f"{label}已保存為欄式檔案 {parquet_file}")
+            except ImportError as e:
+                logging.warning(f"無法匯出Parquet (需要安裝 pyarrow 或 fastparquet): {e}")
+        return csv_file
+
+    def run_profile(self, profile, data_with_ma, date1, date2, executor, deliver=None):
+        """以共用的均線數據執行單一策略設定組的篩選，並輸出CSV、圖表與變化報告
+
+        篩選與訊號索引在目前的執行緒完成；CSV、圖表與寄送提交至 executor 並行執行，
+        回傳最終結果 (篩選結果, PDF路徑, CSV路徑, 變化報告路徑) 的 Future
+        """
+        name = profile['name']
+        output_file = self.profile_path(profile['export_filename'], profile, date2)
+
+        logging.info(f"[{name}] 篩選符合條件的股票...")
+        filtered_stocks = self.filter_stocks(data_with_ma, date1, date2,
+                                             condition=profile['condition'],
+                                             averages=profile['averages'],
+                                             fast=profile['fast'], slow=profile['slow'])
+
+        # 與前次執行比較，產生新增/延續/失敗的變化報告
+        outputs = []
+        delta_file = None
+        delta = self.update_signal_index(profile, data_with_ma, filtered_stocks, date2)
+        if not delta.empty:
+            delta_file = self.profile_path(profile['delta_filename'], profile, date2)
+            outputs.append(executor.submit(self.export_frame, delta, delta_file, f"[{name}] 變化報告"))
         
         # 保存結果
-        pdf_file = None
+        full_stocks = None
+        chart = None
         if not filtered_stocks.empty:
-            filtered_stocks.to_csv(output_file, index=False, encoding='utf_8_sig')
-            logging.info(f"分析結果已保存至 {output_file}")
-            logging.info(f"找到 {len(filtered_stocks)} 支符合條件的股票")
-            # 列出找到的股票
-            for idx, row in filtered_stocks.iterrows():
-                logging.info(f"{row['stock_id']} - {row['stock_name']} ({row['market']})")
+            # 完整清單一次寫出，不做完整排序
+            full_stocks, ranked_stocks = self.rank_stocks(filtered_stocks, data_with_ma, date1, date2,
+                                                          metric=profile['rank_by'], top_n=profile['top_n'])
+            full_file = self.profile_path(profile['full_filename'], profile, date2)
+            outputs.append(executor.submit(self.export_frame, full_stocks, full_file,
+                                           f"[{name}] 完整清單 ({len(full_stocks)} 支)"))
 
-            # 生成並保存圖表
-            pdf_file = self.generate_chart(filtered_stocks)
+            # 報告只保留前N名
+            outputs.append(executor.submit(self.export_frame, ranked_stocks, output_file, f"[{name}] 分析結果"))
+            logging.info(f"[{name}] 找到 {len(full_stocks)} 支符合條件的股票，依 {profile['rank_by']} 列出前 {len(ranked_stocks)} 名")
+            # 列出前N名的股票
+            for rank, stock_id, stock_name, market, value in zip(ranked_stocks['rank'], ranked_stocks['stock_id'],
+                                                                 ranked_stocks['stock_name'], ranked_stocks['market'],
+                                                                 ranked_stocks[profile['rank_by']]):
+                logging.info(f"{rank}. {stock_id} - {stock_name} ({market}) {profile['rank_by']}={value:.2f}")
 
-            return filtered_stocks, pdf_file
+            # 生成並保存圖表
+            chart = executor.submit(self.generate_chart_locked, ranked_stocks,
+                                    self.profile_path(profile['chart_filename'], profile, date2),
+                                    profile['top_n'])
         else:
-            logging.warning("未找到符合條件的股票")
-            return None, None
+            logging.warning(f"[{name}] 未找到符合條件的股票")
+
+        def finish():
+            # 佇列依提交順序執行，等待的輸出工作都已開始，不會佔滿執行緒而互相等待
+            for output in outputs:
+                output.result()
+            pdf_file = chart.result() if chart is not None else None
+            result = (full_stocks, pdf_file, output_file if full_stocks is not None else None, delta_file)
+            if deliver is not None:
+                try:
+                    deliver(profile, result)
+                except Exception as e:
+                    logging.error(f"[{name}] 寄送結果時發生錯誤: {e}")
+            return result
+
+        return executor.submit(finish)
+
+    def generate_chart_locked(self, filtered_stocks, output_pdf, top_n=30):
+        """以鎖保護 pyplot 的全域狀態，讓圖表可在執行緒池中繪製"""
+        with self.chart_lock:
+            return self.generate_chart(filtered_stocks, output_pdf=output_pdf, top_n=top_n)
+
+    def rank_stocks(self, filtered_stocks, data_with_ma, date1, date2, metric='price_change_pct', top_n=30):
+        """計算排名指標並以部分選取取出前N名
+
+        回傳 (加上指標欄位的完整清單, 依指標排序並加上名次的前N名)
+        """
+        date1_str = date1.strftime("%Y%m%d")
+        date2_str = date2.strftime("%Y%m%d")
+        full_stocks = filtered_stocks.copy()
+
+        close1 = full_stocks[f'close_{date1_str}'].to_numpy(dtype=float)
+        close2 = full_stocks[f'close_{date2_str}'].to_numpy(dtype=float)
+        full_stocks['price_change_pct'] = (close2 - close1) / close1 * 100
+
+        # 篩選結果以代號表示，對應回均線數據使用的鍵
+        key = stock_key(data_with_ma)
+        stock_keys = full_stocks['stock_id']
+        if key == 'sid':
+            stock_keys = pd.Series(self.symbols.encode(stock_keys), index=full_stocks.index)
+
+        if metric == 'ma20_distance_pct':
+            ma20_col = f'MA20_{date2_str}'
+            if ma20_col in full_stocks.columns:
+                ma20 = full_stocks[ma20_col].to_numpy(dtype=float)
+            else:
+                day_data = data_with_ma[data_with_ma['date'] == date2].drop_duplicates(key).set_index(key)
+                ma20 = stock_keys.map(day_data['MA20']).to_numpy(dtype=float)
+            full_stocks['ma20_distance_pct'] = (close2 - ma20) / ma20 * 100
+        elif metric == 'volume_surge':
+            # 只對候選股票計算：當日成交量 / 前20個交易日的平均成交量
+            candidates = data_with_ma[data_with_ma[key].isin(stock_keys)]
+            if 'volume' in candidates.columns:
+                today_volume = candidates[candidates['date'] == date2].drop_duplicates(key).set_index(key)['volume']
+                past = candidates[candidates['date'] < date2].sort_values('date')
+                past_volume = past.groupby(key).tail(20).groupby(key)['volume'].mean()
+                full_stocks['volume_surge'] = (stock_keys.map(today_volume) /
+                                               stock_keys.map(past_volume)).to_numpy(dtype=float)
+            else:
+                logging.warning("數據中沒有成交量欄位，無法計算 volume_surge")
+                full_stocks['volume_surge'] = np.nan
+
+        order = select_top_n(full_stocks[metric].to_numpy(dtype=float), top_n)
+        ranked_stocks = full_stocks.iloc[order].reset_index(drop=True)
+        ranked_stocks.insert(0, 'rank', np.arange(1, len(ranked_stocks) + 1))
+        return full_stocks, ranked_stocks
+
+    def update_signal_index(self, profile, data_with_ma, filtered_stocks, date):
+        """以 (策略組, 日期, 股票) 為鍵的訊號索引計算變化報告與連續天數
+
+        new: 當日新出現的訊號；continuing: 先前的訊號當日仍維持在均線同側 (交叉為快線仍在慢線同側)；
+        failed: 先前的訊號當日已回到均線另一側。只查詢前一個有紀錄的日期，
+        不需重新讀取歷史CSV
+        """
+        columns = ['stock_id', 'stock_name', 'market', 'status', 'streak', 'close']
+        if not self.signal_index:
+            return pd.DataFrame(columns=columns)
+
+        name = profile['name']
+        date_str = date.strftime('%Y-%m-%d')
+        index_file = os.path.join(self.export_path, self.signal_index)
+
+        # 當日沒有報價 (未列入假日的停市、資料尚未公布) 時無法判斷訊號是否維持，不寫入索引
+        day_data = data_with_ma[data_with_ma['date'] == date].drop_duplicates(stock_key(data_with_ma))
+        if day_data.empty:
+            logging.warning(f"[{name}] {date_str} 沒有報價資料，不更新訊號索引")
+            return pd.DataFrame(columns=columns)
+        day_data = self.with_symbols(day_data, date).set_index('stock_id')
+
+        with closing(sqlite3.connect(index_file)) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS signals (
+                                profile TEXT NOT NULL,
+                                date TEXT NOT NULL,
+                                stock_id TEXT NOT NULL,
+                                status TEXT NOT NULL,
+                                streak INTEGER NOT NULL,
+                                PRIMARY KEY (profile, date, stock_id))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_signals_stock ON signals (profile, stock_id, date)")
+
+            # 前一個有紀錄的日期中仍有效的訊號
+            prev_date = conn.execute("SELECT MAX(date) FROM signals WHERE profile = ? AND date < ?",
+                                     (name, date_str)).fetchone()[0]
+            active = {}
+            if prev_date is not None:
+                active = dict(conn.execute("""SELECT stock_id, streak FROM signals
+                                              WHERE profile = ? AND date = ? AND status IN ('new', 'continuing')""",
+                                           (name, prev_date)).fetchall())
+
+            new_ids = set()
+            if filtered_stocks is not None and not filtered_stocks.empty:
+                new_ids = set(filtered_stocks['stock_id'])
+
+            # 先前的訊號是否仍維持在均線同側
+            holding = self.holding_mask(day_data, profile)
+
+            rows = []
+            for stock_id in new_ids:
+                if stock_id in active:
+                    rows.append((stock_id, 'continuing', active[stock_id] + 1))
+                else:
+                    rows.append((stock_id, 'new', 1))
+            for stock_id, streak in active.items():
+                if stock_id in new_ids:
+                    continue
+                if holding.get(stock_id, False):
+                    rows.append((stock_id, 'continuing', streak + 1))
+                else:
+                    rows.append((stock_id, 'failed', streak))
+
+            # 重複執行同一天時覆蓋該日的紀錄
+            conn.execute("DELETE FROM signals WHERE profile = ? AND date = ?", (name, date_str))
+            conn.executemany("INSERT INTO signals (profile, date, stock_id, status, streak) VALUES (?, ?, ?, ?, ?)",
+                             [(name, date_str, stock_id, status, streak) for stock_id, status, streak in rows])
+
+        if not rows:
+            return pd.DataFrame(columns=columns)
+
+        delta = pd.DataFrame(rows, columns=['stock_id', 'status', 'streak'])
+        delta = delta.join(day_data[['stock_name', 'market', 'close']], on='stock_id')
+        delta['status'] = pd.Categorical(delta['status'], categories=['new', 'continuing', 'failed'], ordered=True)
+        delta = delta.sort_values(['status', 'streak', 'stock_id'], ascending=[True, False, True])[columns]
+
+        counts = delta['status'].value_counts()
+        logging.info(f"[{name}] 訊號變化: 新增 {counts.get('new', 0)}、延續 {counts.get('continuing', 0)}、失敗 {counts.get('failed', 0)}"
+                     f" (前次紀錄日期: {prev_date})")
+        return delta.reset_index(drop=True)
         
-    def generate_chart(self, filtered_stocks, output_pdf=None):
-        """生成均線突破股票的圖表，並保存為PDF"""
+    def generate_chart(self, filtered_stocks, output_pdf=None, top_n=30):
+        """生成均線突破股票的圖表 (最多 top_n 支)，並保存為PDF"""
         if filtered_stocks is None or filtered_stocks.empty:
             logging.warning("沒有數據可用於生成圖表")
             return None
@@ -682,20 +2080,25 @@ class TWStockAnalyzer:
         date_cols = [col for col in filtered_stocks.columns if 'close_' in col]
         date_strs = [col.replace('close_', '') for col in date_cols]
 
-        # 對股票按照價格變化百分比排序
-        filtered_stocks['price_change_pct'] = ((filtered_stocks[f'close_{date_strs[1]}'] - 
-                                               filtered_stocks[f'close_{date_strs[0]}']) / 
-                                              filtered_stocks[f'close_{date_strs[0]}'] * 100)
+        # 計算價格變化百分比 (不修改傳入的DataFrame)
+        close1 = filtered_stocks[f'close_{date_strs[0]}'].to_numpy(dtype=float)
+        close2 = filtered_stocks[f'close_{date_strs[1]}'].to_numpy(dtype=float)
+        price_change_pct = (close2 - close1) / close1 * 100
 
-        sorted_stocks = filtered_stocks.sort_values('price_change_pct', ascending=False)
+        # 已排名的結果維持原順序，否則以部分選取取出價格變化最大的前N名
+        if 'rank' in filtered_stocks.columns:
+            order = np.arange(len(filtered_stocks))[:top_n or None]
+        else:
+            order = select_top_n(price_change_pct, top_n)
+        sorted_stocks = filtered_stocks.iloc[order]
 
         # 繪製價格變化百分比圖表
         bars = plt.bar(range(len(sorted_stocks)), 
-                       sorted_stocks['price_change_pct'], 
+                       price_change_pct[order], 
                        color='royalblue')
 
         # 添加股票代碼和名稱標籤（x 軸）
-        stock_labels = [f"{row['stock_id']}\n{row['stock_name']}" for _, row in sorted_stocks.iterrows()]
+        stock_labels = [f"{stock_id}\n{stock_name}" for stock_id, stock_name in zip(sorted_stocks['stock_id'], sorted_stocks['stock_name'])]
         plt.xticks(range(len(sorted_stocks)), stock_labels, rotation=90, fontproperties=font)
 
         # 添加數值標籤（柱上百分比）
@@ -726,15 +2129,14 @@ class TWStockAnalyzer:
             plt.close()
             return None
     
-    def run_once(self):
+    def run_once(self, deliver=None):
         """立即執行一次分析"""
         logging.info("立即執行一次分析")
         try:
-            result, pdf_file = self.run_analysis()
-            return result, pdf_file
+            return self.run_analysis(deliver=deliver)
         except Exception as e:
             logging.error(f"執行分析時發生錯誤: {e}")
-            return None, None
+            return {}
         
 def sendemail(to, sub, context, attachments=None):
     config = readconfig()
@@ -751,7 +2153,7 @@ def sendemail(to, sub, context, attachments=None):
     # 創建郵件物件
     email = MIMEMultipart()
     email["From"] = send_email
-    email["To"] = to
+    email["To"] = to if isinstance(to, str) else ", ".join(to)  # 支援多位收件人
     email["Subject"] = sub
     
     # 添加郵件內容
@@ -786,13 +2188,37 @@ def sendemail(to, sub, context, attachments=None):
         print(f"寄送郵件時出錯: {e}")
         return False
     
-def file_exist(expath, filename):
-    # 替換 {date} 占位符為當天日期
-    today = datetime.now().strftime('%Y%m%d')  # 或者你想要的日期格式
-    filename = filename.replace('{date}', today)
-    
-    complete_path = os.path.join(expath, filename)
-    return os.path.exists(complete_path), complete_path, filename
+def deliver_profile(profile, result):
+    """依策略設定組寄送分析結果給對應的收件人"""
+    name = profile['name']
+    result, pdf_file, completepath, delta_file = result
+    if result is not None:
+        print(f"[{name}] 分析完成，找到 {len(result)} 支符合條件的股票")
+    else:
+        print(f"[{name}] 分析完成，未找到符合條件的股票或執行過程中出現錯誤")
+
+    if not profile['to']:
+        print(f"[{name}] 未設定收件人，略過寄送")
+        return False
+
+    # 檢查檔案是否存在
+    if completepath and os.path.exists(completepath):
+        print(f"[{name}] 找到檔案: {completepath}")
+        # 使用有檔案的郵件內容，並添加附件（CSV和PDF）
+        attachments = [completepath]
+        if pdf_file and os.path.exists(pdf_file):
+            attachments.append(pdf_file)
+            print(f"添加圖表PDF附件: {pdf_file}")
+        if delta_file and os.path.exists(delta_file):
+            attachments.append(delta_file)
+        return sendemail(profile['to'], profile['sub'], profile['context'], attachments)
+    else:
+        print(f"[{name}] 找不到檔案: {completepath}")
+        # 使用無檔案的郵件內容，檢查是否有PDF或變化報告可附加
+        attachments = [f for f in (pdf_file, delta_file) if f and os.path.exists(f)]
+        for attachment in attachments:
+            print(f"添加附件: {attachment}")
+        return sendemail(profile['to'], profile['nofile_sub'], profile['nofile_context'], attachments or None)
 
 def work():
     if __name__ == "__main__":
@@ -806,47 +2232,21 @@ def work():
                 print("排程功能尚未實現，請使用系統排程工具如cron或Windows排程器")
                 sys.exit(0)
             else:
-                # 立即執行一次分析
+                # 立即執行一次分析 (所有策略設定組共用同一次抓取與均線計算)，
+                # 每組的輸出完成後即在背景寄送給對應的收件人
                 print("開始執行股票均線突破分析...")
-                result, pdf_file = analyzer.run_once()
-                if result is not None:
-                    print(f"分析完成，找到 {len(result)} 支符合條件的股票")
-                else:
-                    print("分析完成，未找到符合條件的股票或執行過程中出現錯誤")
-                config = readconfig()
-                if not config:
-                    return False
-    
-                # 從配置中獲取設置
-                expath = config["export_path"]
-                filename = config.get('export_filename', 'tw_stock_ma_breakthrough_{date}.csv')
-                to = config["to"]
-
-                sub = config["sub"]
-                context = config["context"]
-
-                nofile_sub = config["nofile_sub"]
-                nofile_context = config["nofile_context"]
-        
-                fileexist, completepath, formatted_filename = file_exist(expath, filename)
-
-                # 檢查檔案是否存在
-                if fileexist:
-                    print(f"找到檔案: {completepath}")
-                    # 使用有檔案的郵件內容，並添加附件（CSV和PDF）
-                    attachments = [completepath]
-                    if pdf_file and os.path.exists(pdf_file):
-                        attachments.append(pdf_file)
-                        print(f"添加圖表PDF附件: {pdf_file}")
-                    sendemail(to, sub, context, attachments)
-                else:
-                    print(f"找不到檔案: {expath}/{formatted_filename}")
-                    # 使用無檔案的郵件內容，檢查是否有PDF可附加
-                    if pdf_file and os.path.exists(pdf_file):
-                        print(f"添加圖表PDF附件: {pdf_file}")
-                        sendemail(to, nofile_sub, nofile_context, pdf_file)
-                    else:
-                        sendemail(to, nofile_sub, nofile_context)
+                delivered = set()
+
+                def deliver(profile, result):
+                    delivered.add(profile['name'])
+                    deliver_profile(profile, result)
+
+                results = analyzer.run_once(deliver=deliver)
+
+                # 分析中斷而未寄送的策略設定組仍寄出無檔案通知
+                for profile in analyzer.profiles:
+                    if profile['name'] not in delivered:
+                        deliver_profile(profile, results.get(profile['name'], (None, None, None, None)))
                 
         except Exception as e:
             print(f"程式執行時發生未預期的錯誤: {e}")
@@ -879,7 +2279,480 @@ def setschedule():
     else:
         print("無法從配置檔案讀取執行時間")
 
+def benchmark_moving_averages(n_stocks=2000, n_days=2500, worker_counts=None, windows=DEFAULT_MA_WINDOWS):
+    """以合成資料量測不同行程數下的均線計算時間，並確認結果與單一行程完全一致"""
+    analyzer = TWStockAnalyzer()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # 合成 n_stocks 支股票、n_days 個交易日的隨機漫步收盤價
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range('2005-01-03', periods=n_days)
+    closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, (n_stocks, n_days)), axis=1))
+    data = pd.DataFrame({
+        'stock_id': np.repeat([f'{1000 + i}' for i in range(n_stocks)], n_days),
+        'date': np.tile(dates, n_stocks),
+        'close': closes.round(2).ravel()
+    })
+
+    if worker_counts is None:
+        worker_counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    ma_cols = [f'MA{window}' for window in windows]
+
+    print(f"均線計算擴展性測試: {n_stocks} 支股票 x {n_days} 個交易日 = {len(data)} 筆")
+    print(f"{'行程數':>6} {'秒數':>10} {'加速比':>8} {'結果一致':>8}")
+    baseline = None
+    rows = []
+    for workers in worker_counts:
+        start = time.perf_counter()
+        result = analyzer.calculate_moving_averages(data, windows=windows, workers=workers)
+        elapsed = time.perf_counter() - start
+
+        ma_values = result[ma_cols].to_numpy()
+        if baseline is None:
+            baseline = (ma_values, elapsed)
+        identical = np.array_equal(ma_values, baseline[0], equal_nan=True)
+        speedup = baseline[1] / elapsed
+        rows.append({'workers': workers, 'seconds': elapsed, 'speedup': speedup, 'identical': identical})
+        print(f"{workers:>6} {elapsed:>10.3f} {speedup:>8.2f} {str(identical):>8}")
+    return pd.DataFrame(rows)
+
+# 黃金輸出比對中刻意改變的行為：(階段, 引擎, 欄位) -> 原因，只豁免指定名稱的引擎；
+# 所有引擎共同的行為改變應寫入凍結的預期輸出 (如 expected_filter_stocks)，而非豁免。
+# 這些差異仍會列在報告中，但不視為失敗
+GOLDEN_WAIVERS = {
+    ('moving_averages', 'interned', 'stock_name'): '整數鍵資料匯出時名稱以主檔中最新的名稱為準',
+}
+
+def reference_parse_twse(content, date):
+    """凍結的參考實作：原始版本 fetch_twse_data 的解析部分，不可為了效能修改"""
+    lines = content.split('\n')
+    start_idx = -1
+    for i, line in enumerate(lines):
+        if '"證券代號"' in line and '"證券名稱"' in line and '"收盤價"' in line:
+            start_idx = i
+            break
+    if start_idx == -1:
+        return pd.DataFrame()
+
+    data_lines = [lines[start_idx]]
+    for line in lines[start_idx+1:]:
+        if line.strip() and re.match(r'^"[0-9]{4,}"', line.strip()):
+            data_lines.append(line)
+        elif line.strip() and '==================================' in line:
+            break
+    if len(data_lines) <= 1:
+        return pd.DataFrame()
+
+    csv_data = []
+    for i, line in enumerate(data_lines):
+        row = next(csv.reader(StringIO(line), delimiter=',', quotechar='"'))
+        if i == 0:
+            header = [col.strip('"').strip() for col in row]
+            try:
+                code_idx = header.index('證券代號')
+                name_idx = header.index('證券名稱')
+                close_idx = header.index('收盤價')
+            except ValueError:
+                return pd.DataFrame()
+        else:
+            if len(row) >= max(code_idx, name_idx, close_idx) + 1:
+                csv_data.append({
+                    'stock_id': row[code_idx].strip('"'),
+                    'stock_name': row[name_idx].strip('"'),
+                    'close': row[close_idx].strip('"').replace(',', '')
+                })
+
+    df = pd.DataFrame(csv_data)
+    df['close'] = pd.to_numeric(df['close'], errors='coerce')
+    df = df.dropna(subset=['close'])
+    df = df[df['stock_id'].str.isdigit()]
+    df['date'] = date
+    return df
+
+def reference_parse_tpex(content, date):
+    """凍結的參考實作：原始版本 fetch_tpex_data 的解析部分，不可為了效能修改"""
+    if "查無資料" in content or "請重新查詢" in content or len(content.strip()) == 0:
+        return pd.DataFrame()
+
+    header_found = False
+    data_lines = []
+    for line in content.split('\n'):
+        if not line.strip():
+            continue
+        if not header_found and ("代號" in line and "名稱" in line and "收盤" in line):
+            header_found = True
+            data_lines.append(line)
+            continue
+        if header_found:
+            if "總計" in line or "加權指數" in line:
+                break
+            if re.match(r'^[0-9]{4,}', line.strip().split(',')[0].strip()):
+                data_lines.append(line)
+    if not header_found or len(data_lines) <= 1:
+        return pd.DataFrame()
+
+    csv_data = []
+    for line in data_lines[1:]:
+        fields = line.split(',')
+        if len(fields) >= 3:
+            stock_id = fields[0].strip()
+            if stock_id.isdigit():
+                csv_data.append({
+                    'stock_id': stock_id,
+                    'stock_name': fields[1].strip(),
+                    'close': fields[2].strip().replace(',', '')
+                })
+
+    df = pd.DataFrame(csv_data)
+    df['close'] = pd.to_numeric(df['close'], errors='coerce')
+    df = df.dropna(subset=['close'])
+    df['date'] = date
+    return df
+
+def reference_moving_averages(data, windows=DEFAULT_MA_WINDOWS):
+    """凍結的參考實作：原始版本逐股票計算的 calculate_moving_averages"""
+    data = data.sort_values(['stock_id', 'date'])
+    result = data.copy()
+    for window in windows:
+        result[f'MA{window}'] = np.nan
+
+    for stock_id, stock_data in data.groupby('stock_id'):
+        stock_df = stock_data.sort_values('date')
+        for window in windows:
+            ma_col = f'MA{window}'
+            if len(stock_df) < window:
+                result.loc[stock_df.index, ma_col] = np.nan
+            else:
+                ma_values = stock_df['close'].rolling(window=window, min_periods=window).mean()
+                result.loc[stock_df.index, ma_col] = ma_values.values
+    return result
+
+def reference_filter_stocks(data, date1, date2):
+    """凍結的參考實作：原始版本的 filter_stocks (MA5/MA10/MA20 突破，嚴格大於/小於)"""
+    if data.empty:
+        return pd.DataFrame()
+    date1_data = data[data['date'] == date1].copy()
+    date2_data = data[data['date'] == date2].copy()
+    if date1_data.empty or date2_data.empty:
+        return pd.DataFrame()
+
+    date1_filtered = date1_data[(date1_data['close'] < date1_data['MA5']) &
+                                (date1_data['close'] < date1_data['MA10']) &
+                                (date1_data['close'] < date1_data['MA20'])]
+    date2_filtered = date2_data[(date2_data['close'] > date2_data['MA5']) &
+                                (date2_data['close'] > date2_data['MA10']) &
+                                (date2_data['close'] > date2_data['MA20'])]
+    common_stocks = set(date1_filtered['stock_id']).intersection(set(date2_filtered['stock_id']))
+    if not common_stocks:
+        return pd.DataFrame()
+
+    result = []
+    for stock_id in common_stocks:
+        info1 = date1_filtered[date1_filtered['stock_id'] == stock_id].iloc[0]
+        info2 = date2_filtered[date2_filtered['stock_id'] == stock_id].iloc[0]
+        result.append({
+            'stock_id': stock_id,
+            'stock_name': info1['stock_name'],
+            'market': info1['market'],
+            f'close_{date1.strftime("%Y%m%d")}': info1['close'],
+            f'MA5_{date1.strftime("%Y%m%d")}': info1['MA5'],
+            f'MA10_{date1.strftime("%Y%m%d")}': info1['MA10'],
+            f'MA20_{date1.strftime("%Y%m%d")}': info1['MA20'],
+            f'close_{date2.strftime("%Y%m%d")}': info2['close'],
+            f'MA5_{date2.strftime("%Y%m%d")}': info2['MA5'],
+            f'MA10_{date2.strftime("%Y%m%d")}': info2['MA10'],
+            f'MA20_{date2.strftime("%Y%m%d")}': info2['MA20']
+        })
+    return pd.DataFrame(result)
+
+def expected_filter_stocks(data, date1, date2):
+    """凍結的預期輸出：參考實作的篩選結果，但名稱與市場刻意改以第二個日期 (最新) 為準"""
+    expected = reference_filter_stocks(data, date1, date2)
+    if expected.empty:
+        return expected
+    latest = data[data['date'] == date2].drop_duplicates('stock_id').set_index('stock_id')
+    expected['stock_name'] = expected['stock_id'].map(latest['stock_name'])
+    expected['market'] = expected['stock_id'].map(latest['market'])
+    return expected
+
+def expected_corporate_actions(data):
+    """凍結的預期輸出：逐股票逐日以參考價 (收盤價 - 漲跌) 與該股票前一筆收盤價判斷公司行動
+
+    個股停牌後仍與停牌前最後的收盤價比較；兩列之間有整個市場都沒有資料的交易日
+    (合成資料不含假日，以週一至週五為交易日) 時不判斷
+    """
+    fetched = set(data['date'])
+    result = []
+    for stock_id, rows in data.sort_values('date').groupby('stock_id'):
+        previous = None
+        for row in rows.itertuples():
+            ref_break, adj_factor = False, 1.0
+            if previous is not None:
+                between = pd.bdate_range(previous.date, row.date)[1:-1]
+                reference = row.close - row.change
+                if all(day in fetched for day in between) and reference > 0 and abs(reference - previous.close) > 0.005:
+                    ref_break, adj_factor = True, reference / previous.close
+            result.append({'stock_id': stock_id, 'date': row.date, 'ref_break': ref_break, 'adj_factor': adj_factor})
+            previous = row
+    return pd.DataFrame(result)
+
+def compare_golden(expected, actual, keys, rtol=1e-9, atol=1e-9):
+    """以鍵對齊後逐欄比較參考輸出與新引擎的輸出，回傳 {欄位: 差異說明}
+
+    只比較參考輸出中的欄位；數值欄位以容許誤差比較且 NaN 的位置必須一致，其餘欄位需完全相同
+    """
+    if expected.empty or actual.empty:
+        if expected.empty != actual.empty:
+            return {'(rows)': f"參考輸出 {len(expected)} 列、新引擎 {len(actual)} 列"}
+        return {}
+    differences = {}
+    missing = [col for col in expected.columns if col not in actual.columns]
+    if missing:
+        differences['(columns)'] = f"新引擎缺少欄位 {missing}"
+    columns = [col for col in expected.columns if col in actual.columns]
+
+    merged = expected[columns].merge(actual[columns], on=keys, how='outer', suffixes=('_ref', '_new'), indicator=True)
+    only_ref = merged[merged['_merge'] == 'left_only']
+    only_new = merged[merged['_merge'] == 'right_only']
+    if len(only_ref) or len(only_new):
+        examples = pd.concat([only_ref, only_new])[keys].head(3).to_dict('records')
+        differences['(rows)'] = f"僅在參考輸出 {len(only_ref)} 列、僅在新引擎 {len(only_new)} 列，例如 {examples}"
+
+    both = merged[merged['_merge'] == 'both']
+    for col in columns:
+        if col in keys:
+            continue
+        ref, new = both[f'{col}_ref'], both[f'{col}_new']
+        if pd.api.types.is_numeric_dtype(ref) and pd.api.types.is_numeric_dtype(new):
+            ref, new = ref.to_numpy(dtype=float), new.to_numpy(dtype=float)
+            nan_mismatch = np.isnan(ref) != np.isnan(new)
+            out_of_tolerance = ~np.isclose(ref, new, rtol=rtol, atol=atol) & ~np.isnan(ref) & ~np.isnan(new)
+            if nan_mismatch.any():
+                differences[col] = f"{int(nan_mismatch.sum())} 列的 NaN 位置不同"
+            elif out_of_tolerance.any():
+                worst = np.max(np.abs(ref - new)[out_of_tolerance])
+                differences[col] = f"{int(out_of_tolerance.sum())} 列超出容許誤差 (最大差 {worst:.3g})"
+        else:
+            mismatch = ref.astype(str).to_numpy() != new.astype(str).to_numpy()
+            if mismatch.any():
+                example = both.loc[mismatch, keys + [f'{col}_ref', f'{col}_new']].head(1).to_dict('records')
+                differences[col] = f"{int(mismatch.sum())} 列不同，例如 {example}"
+    return differences
+
+def synthetic_twse_content(date):
+    """合成TWSE每日收盤行情CSV：含千分位、無成交 (--)、非數字代號、HTML漲跌符號與備註區"""
+    header = ['證券代號', '證券名稱', '成交股數', '成交筆數', '成交金額', '開盤價', '最高價', '最低價',
+              '收盤價', '漲跌(+/-)', '漲跌價差', '最後揭示買價', '最後揭示買量', '最後揭示賣價', '最後揭示賣量', '本益比']
+    rows = [
+        ['1101', '台泥', '12,345,678', '5,432', '400,000,000', '32.50', '33.00', '32.10', '32.80', '<p style= color:red>+</p>', '0.30'],
+        ['1102', '亞泥', '2,000', '10', '90,000', '45.00', '45.20', '44.90', '44.95', '<p style= color:green>-</p>', '0.05'],
+        ['2330', '台積電', '30,000,000', '50,000', '30,000,000,000', '1,000.00', '1,010.00', '995.00', '1,005.00', '<p style= color:red>+</p>', '15.00'],
+        ['2454', '聯發科', '0', '0', '0', '--', '--', '--', '--', ' ', '0.00'],
+        ['2881', '富邦金', '9,000,000', '7,000', '700,000,000', '80.00', '81.00', '79.50', '80.50', 'X', '0.00'],
+        ['2888A', '新光金甲', '1,000', '3', '50,000', '50.00', '50.00', '50.00', '50.00', ' ', '0.00'],
+        ['00632R', '元大台灣50反1', '5,000,000', '900', '20,000,000', '4.00', '4.05', '3.98', '4.01', '<p style= color:red>+</p>', '0.02'],
+    ]
+    lines = [f'"{date.year - 1911}年{date.month:02d}月{date.day:02d}日 每日收盤行情(全部(不含權證、牛熊證))"',
+             '"指數","收盤指數","漲跌(+/-)","漲跌點數","漲跌百分比(%)",',
+             '"發行量加權股價指數","23,000.00","+","100.00","0.44",',
+             '',
+             ','.join(f'"{col}"' for col in header) + ',']
+    for row in rows:
+        row = row + ['0.00', '1', '0.00', '1', '0.00']
+        lines.append(','.join(f'"{value}"' for value in row) + ',')
+    lines.append('="0050","元大台灣50","1,000","1","190,000","190.00","190.00","190.00","190.00","+","1.00",')
+    lines.append('"===================================="')
+    lines.append('"9999","備註後的資料","1","1","1","1.00","1.00","1.00","1.00","+","0.00",')
+    lines.append('"備註:"')
+    return '\n'.join(lines)
+
+def synthetic_tpex_content(date):
+    """合成TPEx每日收盤行情CSV：含除息漲跌、無成交 (---)、帶引號的千分位與總計列"""
+    lines = [f'上櫃股票每日收盤行情(不含定價),,,,,,,,,',
+             f'資料日期:{date.year - 1911}/{date.month:02d}/{date.day:02d},,,,,,,,,',
+             '代號,名稱,收盤 ,漲跌,開盤 ,最高 ,最低,均價 ,成交股數  ,成交金額(元),成交筆數 ',
+             '1240,茂生農經,55.20,+0.10,55.10,55.50,55.00,55.21,120000,6625200,90',
+             '3105,穩懋,128.50,-2.50,131.00,131.50,128.00,129.30,5000000,646500000,4000',
+             '4128,中天,22.10,除息,22.00,22.30,21.90,22.05,300000,6615000,150',
+             '5347,世界,---,---,---,---,---,---,0,0,0',
+             '6488,環球晶,"1,050.00",+5.00,"1,045.00","1,055.00","1,040.00","1,048.00",800000,838400000,900',
+             '8069,元太,210.00,0.00,210.00,212.00,208.00,210.10,2000000,420200000,1500',
+             '006201,元大富櫃50,20.10,+0.05,20.05,20.15,20.00,20.08,30000,602400,20',
+             '管理股票,,,,,,,,,',
+             '總計,,,,,,,,,',
+             '9999,總計之後,1.00,0.00,1.00,1.00,1.00,1.00,1,1,1']
+    return '\n'.join(lines)
+
+def synthetic_quotes(n_stocks=40, n_days=45, seed=0):
+    """合成收盤價資料，並加入均線比對容易出錯的情況：
+
+    資料不足最長窗口 (NaN)、價格持平 (收盤價等於均線)、第二日改名的突破股，
+    以及第一日沒有資料的股票
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2024-01-02', periods=n_days)
+    frames = []
+    for i in range(n_stocks):
+        closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.03, n_days)))
+        frames.append(pd.DataFrame({'stock_id': f'{1101 + i}', 'stock_name': f'股票{1101 + i}',
+                                    'market': 'TWSE' if i % 2 else 'TPEx', 'close': closes.round(2), 'date': dates}))
+
+    # 資料不足：只有最後8個交易日
+    frames.append(pd.DataFrame({'stock_id': '6001', 'stock_name': '新上市', 'market': 'TPEx',
+                                'close': np.linspace(30, 35, 8).round(2), 'date': dates[-8:]}))
+    # 價格持平：收盤價與所有均線相等，嚴格比較下不應被篩選
+    frames.append(pd.DataFrame({'stock_id': '6002', 'stock_name': '持平', 'market': 'TWSE',
+                                'close': 50.0, 'date': dates}))
+    # 連續下跌後於最後一日突破，並在最後一日改名
+    breakout = np.r_[np.linspace(120, 100, n_days - 1), 130.0]
+    frames.append(pd.DataFrame({'stock_id': '6003', 'stock_name': np.where(np.arange(n_days) < n_days - 1, '舊名', '新名'),
+                                'market': 'TWSE', 'close': breakout.round(2), 'date': dates}))
+    # 同樣的走勢但缺少倒數第二日的資料
+    frames.append(pd.DataFrame({'stock_id': '6004', 'stock_name': '缺資料', 'market': 'TPEx',
+                                'close': breakout.round(2), 'date': dates}).drop(index=n_days - 2))
+    return pd.concat(frames, ignore_index=True)
+
+def synthetic_corporate_actions(n_days=12, seed=0):
+    """合成含公司行動的報價：停牌後減資恢復交易、未停牌的除息、停牌後無公司行動，
+    以及整個市場都缺漏的一個交易日 (其後的漲跌相對於缺漏日，不應判斷為公司行動)
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2024-03-04', periods=n_days)
+    frames = []
+    for stock_id in ('2201', '2202', '2203', '2204'):
+        closes = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n_days)))
+        if stock_id == '2202':
+            # 停牌3日後以減資後的參考價 52 恢復交易 (停牌前收盤 104)
+            closes[:5] = 104.0
+            closes[8:] = 52.0 + np.arange(n_days - 8) * 0.5
+        if stock_id == '2203':
+            # 第7日除息 2 元
+            closes[6:] -= 2.0
+        closes = closes.round(2)
+        change = np.r_[np.nan, np.diff(closes)].round(2)
+        if stock_id == '2202':
+            change[8] = 0.0  # 恢復交易的漲跌相對於參考價
+        if stock_id == '2204':
+            change[8] = round(closes[8] - closes[4], 2)  # 無公司行動，參考價為停牌前收盤價
+        if stock_id == '2203':
+            change[6] = round(change[6] + 2.0, 2)  # 漲跌相對於除息參考價
+        frame = pd.DataFrame({'stock_id': stock_id, 'stock_name': f'公司行動{stock_id}', 'market': 'TWSE',
+                              'close': closes, 'change': change, 'date': dates})
+        if stock_id in ('2202', '2204'):
+            frame = frame.drop(index=[5, 6, 7])
+        frames.append(frame)
+    # 整個市場缺漏倒數第二個交易日
+    data = pd.concat(frames, ignore_index=True)
+    return data[data['date'] != dates[-2]].reset_index(drop=True)
+
+def verify_golden_outputs(config_file='config.json', engines=None, rtol=1e-9, atol=1e-9):
+    """黃金輸出比對：以凍結的參考實作與目前 (或新加入) 的引擎處理相同的錄製與合成輸入
+
+    逐欄比較輸出並回報加速比，有未豁免的差異時回傳 False。錄製的輸入為 response_archive
+    中保存的原始回應，以及 export_path 中最近的 raw_stock_data_*.csv。
+    engines 可加入新的引擎：{階段: {名稱: 函式}}，階段為 parse_twse、parse_tpex、
+    moving_averages、filter_stocks、validate_quotes，函式的參數與對應的參考實作相同
+    """
+    analyzer = TWStockAnalyzer(config_file)
+    logging.getLogger().setLevel(logging.ERROR)
+
+    def interned(data):
+        # 以暫時的股票主檔將資料轉為整數鍵 (不寫入檔案)
+        analyzer.symbols = SymbolMaster()
+        analyzer.symbols.update(data)
+        return analyzer.symbols.intern(data)
+
+    stages = {
+        'parse_twse': (reference_parse_twse, ['stock_id'], {'current': analyzer.parse_twse_content}),
+        'parse_tpex': (reference_parse_tpex, ['stock_id'], {'current': analyzer.parse_tpex_content}),
+        'moving_averages': (reference_moving_averages, ['stock_id', 'date'], {
+            'current': lambda data, windows: analyzer.calculate_moving_averages(data, windows, workers=1),
+            'sharded': lambda data, windows: analyzer.calculate_moving_averages(data, windows, workers=2),
+            'interned': lambda data, windows: analyzer.with_symbols(
+                analyzer.calculate_moving_averages(interned(data), windows, workers=1))}),
+        'filter_stocks': (expected_filter_stocks, ['stock_id'], {
+            'current': analyzer.filter_stocks,
+            'interned': lambda data, date1, date2: analyzer.filter_stocks(interned(data), date1, date2)}),
+        'validate_quotes': (expected_corporate_actions, ['stock_id', 'date'], {'current': analyzer.validate_quotes}),
+    }
+    for stage, extra in (engines or {}).items():
+        stages[stage][2].update(extra)
+
+    # 錄製與合成的輸入：(階段, 輸入名稱, 參數)
+    cases = []
+    archive_dir = os.path.join(analyzer.export_path, analyzer.response_archive) if analyzer.response_archive else None
+    if archive_dir and os.path.isdir(archive_dir):
+        for filename in sorted(os.listdir(archive_dir)):
+            match = re.match(r'^(twse|tpex)_(\d{8})\.csv$', filename)
+            if match:
+                with open(os.path.join(archive_dir, filename), encoding='utf-8') as f:
+                    cases.append((f'parse_{match.group(1)}', filename,
+                                  (f.read(), datetime.strptime(match.group(2), '%Y%m%d'))))
+    synthetic_date = datetime(2024, 3, 1)
+    cases.append(('parse_twse', '合成TWSE', (synthetic_twse_content(synthetic_date), synthetic_date)))
+    cases.append(('parse_tpex', '合成TPEx', (synthetic_tpex_content(synthetic_date), synthetic_date)))
+    cases.append(('validate_quotes', '合成公司行動', (synthetic_corporate_actions(),)))
+
+    panels = []
+    raw_files = sorted(f for f in os.listdir(analyzer.export_path) if re.match(r'^raw_stock_data_\d{8}\.csv$', f))
+    for filename in raw_files[-3:]:
+        raw = pd.read_csv(os.path.join(analyzer.export_path, filename), dtype={'stock_id': str}, parse_dates=['date'])
+        if {'stock_id', 'stock_name', 'market', 'close', 'date'}.issubset(raw.columns):
+            panels.append((filename, raw[['stock_id', 'stock_name', 'market', 'close', 'date']]))
+    panels.append(('合成資料', synthetic_quotes()))
+    for name, data in panels:
+        cases.append(('moving_averages', name, (data, DEFAULT_MA_WINDOWS)))
+        # 篩選以參考實作的均線為共同輸入，只比較篩選本身
+        dates = sorted(data['date'].unique())
+        if len(dates) >= 2:
+            date1, date2 = [pd.Timestamp(d).to_pydatetime() for d in dates[-2:]]
+            cases.append(('filter_stocks', name, (reference_moving_averages(data), date1, date2)))
+
+    print(f"{'階段':<16} {'輸入':<28} {'引擎':<10} {'參考秒數':>9} {'引擎秒數':>9} {'加速比':>7}  結果")
+    passed = True
+    for stage, name, args in cases:
+        reference, keys, stage_engines = stages[stage]
+        start = time.perf_counter()
+        expected = reference(*args)
+        reference_seconds = time.perf_counter() - start
+
+        for engine, function in stage_engines.items():
+            start = time.perf_counter()
+            try:
+                actual = function(*args)
+                differences = compare_golden(expected, actual, keys, rtol=rtol, atol=atol)
+            except Exception as e:
+                differences = {'(error)': f"{type(e).__name__}: {e}"}
+            engine_seconds = time.perf_counter() - start
+
+            failures = {}
+            for col, message in differences.items():
+                reason = GOLDEN_WAIVERS.get((stage, engine, col))
+                if reason:
+                    print(f"    [已知差異] {stage}/{engine} {col}: {message} ({reason})")
+                else:
+                    failures[col] = message
+            status = '一致' if not failures else '不一致'
+            print(f"{stage:<16} {name[:28]:<28} {engine:<10} {reference_seconds:>9.4f} {engine_seconds:>9.4f} "
+                  f"{reference_seconds / max(engine_seconds, 1e-9):>7.2f}  {status}")
+            for col, message in failures.items():
+                print(f"    {col}: {message}")
+            passed &= not failures
+
+    print("黃金輸出比對通過" if passed else "黃金輸出比對失敗：新引擎的結果與參考實作不一致")
+    return passed
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        # 均線計算的多行程擴展性測試：--benchmark [股票數] [交易日數]
+        n_stocks = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        n_days = int(sys.argv[3]) if len(sys.argv) > 3 else 2500
+        benchmark_moving_averages(n_stocks, n_days)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "--verify":
+        # 黃金輸出比對：與參考實作不一致時以非零狀態結束
+        sys.exit(0 if verify_golden_outputs() else 1)
+
     print("開始監控排程...")
     setschedule()  # 初始設置排程
     